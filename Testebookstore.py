@@ -2,9 +2,16 @@
 from datetime import datetime
 from decimal import Decimal
 from io import StringIO
+import json
+import os
+import pickle
 import sys
+import tempfile
+import threading
+import urllib.request
 
-from ebookstore import EBook, Customer, CustomerList, Order, Catalog, ShoppingCart
+import ebookstore
+from ebookstore import EBook, Customer, CustomerList, Order, Catalog, ShoppingCart, Metrics, Tracer, SalesAnalytics, CoPurchaseIndex, OrderJournal, OrderHistory, CartSessionStore, ShardedStore, LoadGenerator
 
 def test_catalog_operations():
     # Create a catalog
@@ -229,10 +236,663 @@ def test_invoice_generation():
     print("Invoice generation test passed.")
 
 
+def test_metrics_instrumentation():
+    """Test case to verify opt-in instrumentation and the Prometheus export."""
+
+    print("\nTesting Metrics Instrumentation:")
+    original_add_item = Catalog.add_item
+    metrics = Metrics()
+    metrics.enable()
+    try:
+        catalog = Catalog()
+        ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+        catalog.add_item(ebook1)
+        catalog.find_by_title("E-Book One")
+        customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+        shopping_cart = ShoppingCart(customer)
+        shopping_cart.add_item(ebook1, quantity=3)
+        shopping_cart.create_order(datetime(2024, 1, 1))
+
+        snapshot = metrics.snapshot()
+        assert snapshot["calls"]["Catalog.add_item"] == 1, "Catalog.add_item call was not counted"
+        assert snapshot["calls"]["Order.add_ebook"] == 3, "Per-copy order expansion was not counted"
+        assert snapshot["latency"]["ShoppingCart.create_order"]["buckets"][float("inf")] == 1, "Histogram is incomplete"
+        assert snapshot["collection_sizes"]["Order"] == 3, "Order size was not recorded"
+
+        text = metrics.to_prometheus()
+        assert 'ebookstore_calls_total{method="Catalog.find_by_title"} 1' in text, "Counter missing from export"
+        assert 'ebookstore_call_duration_seconds_bucket{method="Catalog.add_item",le="+Inf"} 1' in text, "Histogram missing from export"
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ebookstore.prom")
+            metrics.export_prometheus(path)
+            with open(path, encoding="utf-8") as file:
+                assert file.read() == text, "Exported file does not match the metrics text"
+
+        server = metrics.serve_prometheus(port=0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url) as response:
+                assert b"ebookstore_collection_size" in response.read(), "Metrics endpoint returned no gauges"
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        metrics.disable()
+
+    assert Catalog.add_item is original_add_item, "Disabling instrumentation did not restore the original method"
+    print(text)
+
+
+def test_checkout_tracing():
+    """Test case to verify checkout spans and their parent/child links."""
+
+    print("\nTesting Checkout Tracing:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkout.jsonl")
+        tracer = Tracer(path, sample_rate=1.0)
+        tracer.enable()
+        try:
+            with tracer.span("checkout", customer=customer.get_email()):
+                shopping_cart = ShoppingCart(customer)
+                shopping_cart.add_item(ebook1, quantity=2)
+                order = shopping_cart.create_order(datetime(2024, 1, 1))
+                invoice = order.render_invoice()
+        finally:
+            tracer.disable()
+
+        with open(path, encoding="utf-8") as file:
+            events = [json.loads(line) for line in file]
+
+    assert "Total:" in invoice, "Invoice was not rendered while traced"
+    spans = {event["name"]: event for event in events}
+    root = spans["checkout"]
+    assert root["args"]["parent_id"] is None, "Checkout span should be the root"
+    for name in ("cart.add_item", "order.create", "invoice.render"):
+        assert spans[name]["args"]["parent_id"] == root["args"]["span_id"], f"{name} is not a child of checkout"
+        assert spans[name]["args"]["trace_id"] == root["args"]["trace_id"], f"{name} belongs to another trace"
+    assert spans["order.vat"]["args"]["parent_id"] == spans["invoice.render"]["args"]["span_id"], "VAT span is not nested in the invoice"
+    assert spans["order.apply_discounts"]["args"]["parent_id"] == spans["invoice.render"]["args"]["span_id"], "Discount span is not nested in the invoice"
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events), "Spans are not complete trace events"
+
+    unsampled = Tracer(sample_rate=0.0)
+    unsampled.enable()
+    try:
+        ShoppingCart(customer).add_item(ebook1)
+    finally:
+        unsampled.disable()
+    assert unsampled.get_spans() == [], "Unsampled traces should not record spans"
+    print(f"Recorded {len(events)} spans for one checkout")
+
+
+def test_sales_analytics():
+    """Test case to verify incremental sales aggregates and bestseller tracking."""
+
+    print("\nTesting Incremental Sales Analytics:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    ebook3 = EBook("E-Book Three", "Author A", datetime(2022, 3, 1), "Fiction", Decimal('15.00'), "PDF")
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+
+    analytics = SalesAnalytics(top_k=2, window_days=2)
+    ShoppingCart.add_order_listener(analytics.record_order)
+    try:
+        shopping_cart = ShoppingCart(customer)
+        shopping_cart.add_item(ebook1, quantity=3)
+        shopping_cart.add_item(ebook2, quantity=1)
+        shopping_cart.create_order(datetime(2024, 1, 1))
+
+        shopping_cart = ShoppingCart(customer)
+        shopping_cart.add_item(ebook3, quantity=2)
+        shopping_cart.add_item(ebook2, quantity=1)
+        shopping_cart.create_order(datetime(2024, 1, 3, 12, 30))
+    finally:
+        ShoppingCart.remove_order_listener(analytics.record_order)
+
+    assert analytics.get_order_count() == 2, "Orders were not recorded"
+    assert analytics.get_total_revenue() == Decimal('100.00'), "Total revenue is incorrect"
+    assert analytics.get_revenue_by_genre("Fiction") == Decimal('60.00'), "Genre revenue is incorrect"
+    assert analytics.get_revenue_by_author("Author A") == Decimal('60.00'), "Author revenue is incorrect"
+    assert analytics.get_revenue_by_file_format("EPUB") == Decimal('40.00'), "Format revenue is incorrect"
+    assert analytics.get_units_by_genre("Fiction") == 5, "Genre units are incorrect"
+    assert analytics.get_daily_sales(datetime(2024, 1, 3).date())["revenue"] == Decimal('50.00'), "Daily sales are incorrect"
+    assert analytics.get_daily_sales(datetime(2024, 1, 1).date())["orders"] == 0, "Days outside the window should expire"
+    assert analytics.get_top_sellers() == [("E-Book One", 3), ("E-Book Three", 2)], "Bestsellers are incorrect"
+    print(f"Top sellers: {analytics.get_top_sellers()}")
+
+
+def test_co_purchase_index():
+    """Test case to verify co-purchase recommendations, compaction and persistence."""
+
+    print("\nTesting Co-Purchase Index:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    ebook3 = EBook("E-Book Three", "Author C", datetime(2022, 3, 1), "Fiction", Decimal('15.00'), "MOBI")
+    for ebook in (ebook1, ebook2, ebook3):
+        catalog.add_item(ebook)
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+
+    index = CoPurchaseIndex(min_count=2, compact_every=None)
+    ShoppingCart.add_order_listener(index.record_order)
+    try:
+        for basket in ((ebook1, ebook2), (ebook1, ebook2, ebook3), (ebook1, ebook1)):
+            shopping_cart = ShoppingCart(customer)
+            for ebook in basket:
+                shopping_cart.add_item(ebook)
+            shopping_cart.create_order(datetime(2024, 1, 1))
+    finally:
+        ShoppingCart.remove_order_listener(index.record_order)
+
+    assert index.get_related(ebook1) == [(ebook2, 2), (ebook3, 1)], "Related e-books are ranked incorrectly"
+    assert index.get_related(ebook1, n=1) == [(ebook2, 2)], "Top-N limit is not applied"
+
+    index.compact()
+    assert index.get_related(ebook1) == [(ebook2, 2)], "Compaction should drop rare pairs"
+    assert index.get_related(ebook3) == [], "Compaction should drop e-books without frequent pairs"
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "co_purchases.json")
+        index.save(path)
+        restored = CoPurchaseIndex.load(path, catalog)
+    assert restored.get_related(ebook2) == [(ebook1, 2)], "Index was not restored from disk"
+    print(f"Customers who bought {ebook1.get_title()} also bought: {[ebook.get_title() for ebook, _ in index.get_related(ebook1)]}")
+
+
+def test_order_journal_recovery():
+    """Test case to verify journaled orders survive a crash and are replayed."""
+
+    print("\nTesting Order Journal:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    catalog.add_item(ebook1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = OrderJournal(directory, batch_size=4, segment_bytes=512)
+        ShoppingCart.add_order_listener(journal.append)
+        try:
+            def checkout(number):
+                customer = Customer(f"Customer {number}", f"customer{number}@example.com", "+1234567890")
+                customer.set_loyalty_points(number)
+                shopping_cart = ShoppingCart(customer)
+                shopping_cart.add_item(ebook1, quantity=2)
+                shopping_cart.add_item(ebook2, quantity=1)
+                shopping_cart.create_order(datetime(2024, 1, 1))
+
+            workers = [threading.Thread(target=checkout, args=(number,)) for number in range(8)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            ShoppingCart.remove_order_listener(journal.append)
+            journal.close()
+
+        segments = OrderJournal.list_segments(directory)
+        assert len(segments) > 1, "Journal segments were not rotated"
+        with open(segments[-1], "ab") as file:
+            file.write(b'{"date":"2024-01-01T00:00:00","customer":["Torn')  # Simulate a crash mid-write
+
+        orders, customers = OrderJournal.replay(directory, catalog)
+        benchmark = OrderJournal.benchmark(os.path.join(directory, "bench"), batch_sizes=(1, 8), orders=32, threads=4)
+
+    assert len(orders) == 8, "Not every order was replayed"
+    assert all(order.get_total_price() == Decimal('40.00') for order in orders), "Replayed order totals are incorrect"
+    assert all(order.get_ebooks()[0] is ebook1 for order in orders), "Catalog e-books were not reused on replay"
+    assert customers["customer5@example.com"].get_loyalty_points() == 5, "Loyalty points were not restored"
+    assert set(benchmark) == {1, 8} and all(rate > 0 for rate in benchmark.values()), "Benchmark did not report throughput"
+    print(f"Replayed {len(orders)} orders; orders/sec by fsync batch size: "
+          f"{ {size: round(rate) for size, rate in benchmark.items()} }")
+
+
+def test_order_history():
+    """Test case to verify per-customer order history queries and history-based loyalty."""
+
+    print("\nTesting Order History:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+    other_customer = Customer("Jane Roe", "jane.roe@example.com", "+1234567891")
+
+    history = OrderHistory(loyalty_min_orders=2)
+    ShoppingCart.add_order_listener(history.record_order)
+    try:
+        orders = []
+        for order_date in (datetime(2024, 8, 15), datetime(2024, 2, 1), datetime(2024, 7, 1), datetime(2024, 10, 2)):
+            shopping_cart = ShoppingCart(customer)
+            shopping_cart.add_item(ebook1, quantity=1)
+            orders.append(shopping_cart.create_order(order_date, order_history=history))
+        shopping_cart = ShoppingCart(other_customer)
+        shopping_cart.add_item(ebook1, quantity=1)
+        shopping_cart.create_order(datetime(2024, 8, 1))
+    finally:
+        ShoppingCart.remove_order_listener(history.record_order)
+
+    q3_orders = history.get_orders(customer, datetime(2024, 7, 1), datetime(2024, 10, 1))
+    assert [order.get_order_date().month for order in q3_orders] == [7, 8], "Q3 range query is incorrect"
+    assert history.get_order_count(customer) == 4, "Order count is incorrect"
+    assert history.get_order_count(other_customer) == 1, "Orders are mixed between customers"
+    # Loyalty is decided when each order is created; backdated orders recorded later do not change it.
+    assert orders[3].apply_discounts() == Decimal('9.00'), "Returning customer should receive the loyalty discount"
+    assert orders[1].apply_discounts() == Decimal('10.00'), "First order should not receive the loyalty discount"
+    assert orders[0].apply_discounts() == Decimal('10.00'), "A later backdated order should not change an earlier discount"
+    charged = [order.apply_discounts() + order.get_vat_amount() for order in orders]
+    assert history.get_lifetime_value(customer) == sum(charged), "Lifetime value should match the amounts charged"
+    assert history.get_spend(customer, datetime(2024, 7, 1), datetime(2024, 10, 1)) == charged[2] + charged[0], "Range spend is incorrect"
+    print(f"Lifetime value for {customer.get_name()}: {history.get_lifetime_value(customer):.2f}")
+
+
+def test_catalog_bulk_operations():
+    """Test case to verify atomic bulk upsert, repricing and removal in the Catalog."""
+
+    print("\nTesting Catalog Bulk Operations:")
+    catalog = Catalog()
+    catalog.add_item(EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF"))
+    catalog.add_item(EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB"))
+
+    # 1. A batch with an invalid row changes nothing
+    results = catalog.bulk_upsert([
+        {"title": "e-book one", "price": Decimal('12.00')},
+        {"title": "E-Book Three", "author": "Author C"},
+    ])
+    assert [result["status"] for result in results] == ["skipped", "rejected"], "Invalid batch was not rejected"
+    assert catalog.find_by_title("E-Book One").get_price() == Decimal('10.00'), "Rejected batch modified the catalog"
+    assert len(catalog.list_items()) == 2, "Rejected batch added e-books"
+    results = catalog.bulk_upsert([
+        {"title": "E-Book One", "price": "NaN"},
+        {"title": "E-Book Two", "prcie": Decimal('5.00')},
+    ])
+    assert [result["status"] for result in results] == ["rejected", "rejected"], "Non-finite prices and unknown fields should be rejected"
+    results = catalog.bulk_upsert([
+        {"title": "E-Book One", "price": "2"},
+        {"title": "E-Book Two", "genre": {"x": 1}},
+        {"title": 7, "price": "2"},
+        {"title": "E-Book Two", "publication_date": "2022-02-01"},
+    ])
+    assert [result["status"] for result in results] == ["skipped", "rejected", "rejected", "rejected"], "Badly typed fields should be rejected"
+    assert catalog.find_by_title("E-Book One").get_price() == Decimal('10.00'), "Rejected batch modified the catalog"
+    assert catalog.find_by_title("E-Book Two").get_price() == Decimal('20.00'), "Rejected batch modified the catalog"
+
+    # 2. Upsert by title
+    results = catalog.bulk_upsert([
+        {"title": "e-book one", "price": Decimal('12.00')},
+        {"title": "E-Book Three", "author": "Author C", "publication_date": datetime(2022, 3, 1),
+         "genre": "Fiction", "price": "15.00", "file_format": "MOBI"},
+    ])
+    assert [result["status"] for result in results] == ["updated", "inserted"], "Upsert results are incorrect"
+    assert catalog.find_by_title("E-Book One").get_price() == Decimal('12.00'), "Upsert did not update the price"
+    assert catalog.find_by_title("E-Book Three").get_price() == Decimal('15.00'), "Upsert did not insert the e-book"
+
+    # 3. Reprice a genre
+    results = catalog.bulk_reprice(factor=Decimal('0.5'), genre="Fiction")
+    assert {result["title"]: result["new_price"] for result in results} == {
+        "E-Book One": Decimal('6.00'), "E-Book Three": Decimal('7.50')}, "Genre repricing is incorrect"
+    results = catalog.bulk_reprice(price=Decimal('-1'), predicate=lambda ebook: ebook.get_price() > 10)
+    assert [result["status"] for result in results] == ["rejected"], "Negative repricing was not rejected"
+    assert catalog.find_by_title("E-Book Two").get_price() == Decimal('20.00'), "Rejected repricing changed a price"
+    for bad_argument in ({"factor": float('inf')}, {"price": "abc"}, {"factor": "x"}):
+        try:
+            catalog.bulk_reprice(**bad_argument)
+            assert False, f"Invalid repricing argument should raise: {bad_argument}"
+        except ValueError:
+            pass
+    catalog.find_by_title("E-Book Two").set_price(20.0)
+    results = catalog.bulk_reprice(factor=Decimal('2'))
+    assert [result["status"] for result in results] == ["skipped", "rejected", "skipped"], "Unrepriceable e-book should be rejected"
+    catalog.find_by_title("E-Book Two").set_price(Decimal('20.00'))
+
+    # 4. Delete many
+    results = catalog.bulk_remove(["e-book one", "E-Book Three", "E-Book Four"])
+    assert [result["status"] for result in results] == ["removed", "removed", "not found"], "Bulk removal results are incorrect"
+    assert [ebook.get_title() for ebook in catalog.list_items()] == ["E-Book Two"], "Bulk removal left the wrong e-books"
+    print("\n", catalog)
+
+
+def test_cart_totals_follow_price_changes():
+    """Test case to verify open cart totals are updated when a catalog price changes."""
+
+    print("\nTesting Reactive Cart Totals:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    catalog.add_item(ebook1)
+    catalog.add_item(ebook2)
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+
+    holding_cart = ShoppingCart(customer)
+    holding_cart.add_item(ebook1, quantity=2)
+    holding_cart.add_item(ebook2, quantity=1)
+    other_cart = ShoppingCart(customer)
+    other_cart.add_item(ebook2, quantity=1)
+
+    catalog.modify_item("E-Book One", price=Decimal('12.50'))
+    assert holding_cart.get_total_price() == Decimal('45.00'), "Cart total did not follow the price change"
+    assert other_cart.get_total_price() == Decimal('20.00'), "Cart without the e-book should be unaffected"
+
+    holding_cart.update_quantity(ebook1, quantity=1)
+    ebook1.set_price(Decimal('8.00'))
+    assert holding_cart.get_total_price() == Decimal('28.00'), "Updated quantity was not used for the price delta"
+
+    holding_cart.remove_item(ebook1)
+    assert holding_cart.get_total_price() == Decimal('20.00'), "Removing a repriced e-book left a stale total"
+    ebook1.set_price(Decimal('99.00'))
+    assert holding_cart.get_total_price() == Decimal('20.00'), "Removed e-book should no longer update the cart"
+    print("\n", holding_cart)
+
+
+def test_cart_session_store():
+    """Test case to verify cart session TTL expiry, LRU eviction and spill-to-disk reload."""
+
+    print("\nTesting Cart Session Store:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    catalog.add_item(ebook1)
+    customer1 = Customer("John Doe", "john.doe@example.com", "+1234567890")
+    customer2 = Customer("Jane Roe", "jane.roe@example.com", "+1234567891")
+    customer3 = Customer("Jim Poe", "jim.poe@example.com", "+1234567892")
+    now = [0.0]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = CartSessionStore(max_carts=2, ttl=60, spill_directory=directory, catalog=catalog,
+                                 clock=lambda: now[0], wall_clock=lambda: now[0])
+        store.get_cart(customer1).add_item(ebook1, quantity=2)
+        assert store.get_cart(customer1).get_total_price() == Decimal('20.00'), "Cart was not kept for its customer"
+        store.get_cart(customer2)
+        store.get_cart(customer3)  # Evicts and spills the least recently used cart
+        assert len(store) == 2, "Cart cap was not enforced"
+
+        ebook1.set_price(Decimal('12.00'))
+        reloaded_cart = store.get_cart(customer1)
+        assert reloaded_cart.get_items()[0][0] is ebook1, "Reloaded cart should use the catalog e-book"
+        assert reloaded_cart.get_total_price() == Decimal('24.00'), "Reloaded cart should use the current price"
+
+        now[0] = 120.0
+        assert store.expire() == 2, "Idle carts did not expire"
+        stats = store.get_stats()
+
+        # Spilled carts expire too, and a half-written spill file is ignored.
+        store = CartSessionStore(max_carts=1, ttl=60, spill_directory=directory, catalog=catalog,
+                                 clock=lambda: now[0], wall_clock=lambda: now[0])
+        store.get_cart(customer1).add_item(ebook1)
+        store.get_cart(customer2).add_item(ebook1)
+        store.get_cart(customer3)  # Spills both earlier carts
+        now[0] = 200.0
+        assert store.get_cart(customer1).get_items() == [], "A cart spilled longer than the TTL ago was reloaded"
+        assert store.expire() == 1, "Expired spill files were not removed"
+        assert os.listdir(directory) == [], "Expired spill files were left on disk"
+        with open(os.path.join(directory, "partial.json"), "w", encoding="utf-8") as file:
+            file.write('{"email": "jim.poe')
+        assert store.expire() == 0 and os.listdir(directory) == [], "Unreadable spill file was not removed"
+
+    assert stats["hits"] == 1 and stats["misses"] == 4, "Hit/miss counters are incorrect"
+    assert stats["evictions"] == 2 and stats["spills"] == 1 and stats["reloads"] == 1, "Eviction counters are incorrect"
+    assert stats["expirations"] == 2 and stats["carts"] == 0, "Expiration counters are incorrect"
+
+    # Carts filled after get_cart still count towards the item cap.
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    store = CartSessionStore(max_items=10, clock=lambda: now[0])
+    customers = [Customer(f"Customer {number}", f"customer{number}@example.com", "+1234567890") for number in range(5)]
+    for customer in customers:
+        cart = store.get_cart(customer)
+        for _ in range(4):
+            cart.add_item(ebook1)
+        cart.update_quantity(ebook2, 2)
+    item_stats = store.get_stats()
+    assert item_stats["evictions"] == 3 and item_stats["carts"] == 2, "Item cap did not evict filled carts"
+    assert item_stats["items"] == 10, "Line count should follow cart mutations"
+    cart.remove_item(ebook2)
+    assert store.get_stats()["items"] == 9, "Removed lines were not counted"
+    print(f"Session store stats: {stats}")
+
+
+def test_categorical_interning():
+    """Test case to verify pooled categorical fields, code-based filters and the memory report."""
+
+    print("\nTesting Categorical Field Interning:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "".join(["Fic", "tion"]), Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "".join(["Fict", "ion"]), Decimal('20.00'), "EPUB")
+    ebook3 = EBook("E-Book Three", "Author A", datetime(2022, 3, 1), "Non-Fiction", Decimal('15.00'), "PDF")
+    for ebook in (ebook1, ebook2, ebook3):
+        catalog.add_item(ebook)
+
+    assert ebook1.get_genre() is ebook2.get_genre(), "Equal genres should share one pooled string"
+    assert ebook1.get_genre_code() == ebook2.get_genre_code(), "Equal genres should share one code"
+    assert catalog.filter_by_genre("Fiction") == [ebook1, ebook2], "Genre filter is incorrect"
+    assert catalog.filter_by_file_format("PDF") == [ebook1, ebook3], "File format filter is incorrect"
+    assert catalog.filter_by_genre("Poetry") == [], "Unknown genre should match nothing"
+
+    ebook3.set_genre("Fiction")
+    assert catalog.filter_by_genre("Fiction") == [ebook1, ebook2, ebook3], "Setter did not re-encode the genre"
+    copy = pickle.loads(pickle.dumps(ebook3))
+    assert (copy.get_author(), copy.get_genre(), copy.get_file_format()) == ("Author A", "Fiction", "PDF"), "Pickled e-book lost its fields"
+
+    report = Catalog.categorical_memory_report(titles=10000, authors=100)
+    assert report["distinct_authors"] == 100 and report["distinct_file_formats"] == 4, "Memory report counts are incorrect"
+    assert report["pooled_bytes"] < report["unpooled_bytes"], "Pooling should save memory"
+    print(f"Memory report: {report}")
+
+
+def test_sharded_store():
+    """Test case to verify hash-sharded customers and carts across worker processes."""
+
+    print("\nTesting Sharded Store:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+
+    with ShardedStore(num_shards=3) as store:
+        for number in range(12):
+            customer = Customer(f"Customer {number}", f"customer{number}@example.com", "+1234567890")
+            customer.set_loyalty_points(number)
+            store.add_customer(customer)
+            store.add_to_cart(customer.get_email(), ebook1, quantity=2)
+        assert store.get_customer_count() == 12, "Customers were lost across shards"
+        assert store.get_total_loyalty_points() == sum(range(12)), "Scatter-gather loyalty total is incorrect"
+        assert len({store.get_shard_index(f"customer{number}@example.com") for number in range(12)}) > 1, "Customers were not spread across shards"
+
+        assert store.add_to_cart("customer1@example.com", ebook2) == Decimal('40.00'), "Cart total is incorrect"
+        assert store.update_quantity("customer1@example.com", ebook1, 1) == Decimal('30.00'), "Quantity update is incorrect"
+        assert store.remove_from_cart("customer1@example.com", ebook2) == Decimal('10.00'), "Cart removal is incorrect"
+
+        # A failed rebalance keeps the old shards and their data.
+        original_import = ebookstore._ShardServer._op_import
+        ebookstore._ShardServer._op_import = lambda server, entries: 1 / 0
+        try:
+            store.resize(2)
+            assert False, "Failed rebalancing should raise"
+        except ZeroDivisionError:
+            pass
+        finally:
+            ebookstore._ShardServer._op_import = original_import
+        assert store.get_num_shards() == 3, "Failed rebalancing should keep the old shards"
+        assert store.get_customer_count() == 12, "Failed rebalancing lost customers"
+        assert store.get_cart_total("customer1@example.com") == Decimal('10.00'), "Failed rebalancing lost the cart"
+
+        # Requests from other threads wait for the rebalance instead of failing or being lost.
+        stop = threading.Event()
+        errors = []
+        added = [0]
+
+        def add_during_resize():
+            while not stop.is_set():
+                try:
+                    store.add_to_cart("customer2@example.com", ebook2)
+                    added[0] += 1
+                except Exception as error:
+                    errors.append(error)
+
+        writer = threading.Thread(target=add_during_resize)
+        writer.start()
+        try:
+            store.resize(4)
+            store.resize(2)
+        finally:
+            stop.set()
+            writer.join()
+        assert not errors, f"Requests failed during rebalancing: {errors[:3]}"
+        expected = Decimal('20.00') + Decimal('20.00') * added[0]
+        assert store.get_cart_total("customer2@example.com") == expected, "Writes were lost during rebalancing"
+        assert store.get_num_shards() == 2, "Store was not resized"
+        assert store.get_customer_count() == 12, "Rebalancing lost customers"
+        assert store.get_cart_total("customer1@example.com") == Decimal('10.00'), "Rebalancing lost the cart"
+        order = store.checkout("customer5@example.com", datetime(2024, 1, 1))
+        assert order.get_total_price() == Decimal('20.00'), "Order from a shard is incorrect"
+        assert order.get_customer().get_loyalty_points() == 5, "Order customer was not carried over"
+        assert store.get_cart_total("customer5@example.com") == Decimal('0.00'), "Checkout should close the cart"
+
+        # Catalog price changes reach the shards' open carts.
+        catalog = Catalog()
+        catalog.add_item(ebook1)
+        catalog.modify_item("E-Book One", price=Decimal('12.00'))
+        assert store.get_cart_total("customer0@example.com") == Decimal('24.00'), "Sharded cart did not follow the price change"
+        assert store.checkout("customer0@example.com", datetime(2024, 1, 1)).get_total_price() == Decimal('24.00'), "Checkout charged a stale price"
+
+        try:
+            store.add_to_cart("nobody@example.com", ebook1)
+            assert False, "Unknown customers should be rejected"
+        except KeyError:
+            pass
+    print(f"Sharded order total: {order.get_total_price():.2f}")
+
+
+def test_load_generator():
+    """Test case to verify synthesized and replayed load runs report latency percentiles."""
+
+    print("\nTesting Load Generator:")
+    catalog = Catalog()
+    catalog.add_item(EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF"))
+    catalog.add_item(EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB"))
+    customers = [Customer(f"Customer {number}", f"customer{number}@example.com", "+1234567890") for number in range(3)]
+    generator = LoadGenerator(catalog, customers, rate=2000, concurrency=3)
+
+    operations = generator.synthesize(300, seed=7)
+    assert operations == generator.synthesize(300, seed=7), "Seeded streams should be reproducible"
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, "traffic.jsonl")
+        LoadGenerator.save_log(operations, log_path)
+        replayed = LoadGenerator.load_log(log_path)
+        assert replayed == operations, "Recorded log did not round-trip"
+
+        results = generator.run(replayed)
+        results_path = os.path.join(directory, "results.json")
+        LoadGenerator.save_results(results, results_path)
+        saved = LoadGenerator.load_results(results_path)
+
+    assert set(results["operations"]) == {"search", "cart_edit", "create_order", "render_invoice"}, "Operation types are missing"
+    for summary in results["operations"].values():
+        assert summary["p50"] <= summary["p95"] <= summary["p99"] <= summary["p999"] <= summary["max"], "Percentiles are out of order"
+    assert results["throughput"] > 0, "Throughput was not reported"
+    comparison = LoadGenerator.compare_results(saved, results)
+    assert comparison["search"]["p99"] == 1.0, "Comparing a run with itself should give a ratio of 1.0"
+    print(f"Throughput: {results['throughput']:.0f} ops/sec, "
+          f"search p99: {results['operations']['search']['p99']:.3f} ms")
+
+
+def test_sharded_checkout_notifies_listeners():
+    """Test case to verify sharded checkouts reach the order listeners of the parent process."""
+
+    print("\nTesting Sharded Checkout Listeners:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+    analytics = SalesAnalytics()
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = OrderJournal(directory, batch_size=1)
+        ShoppingCart.add_order_listener(journal.append)
+        ShoppingCart.add_order_listener(analytics.record_order)
+        try:
+            # Workers started while listeners are registered must not run them.
+            with ShardedStore(num_shards=2) as store:
+                store.add_customer(customer)
+                store.add_to_cart(customer.get_email(), ebook1, quantity=2)
+                order = store.checkout(customer.get_email(), datetime(2024, 1, 1))
+        finally:
+            ShoppingCart.remove_order_listener(analytics.record_order)
+            ShoppingCart.remove_order_listener(journal.append)
+            journal.close()
+        orders, _ = OrderJournal.replay(directory)
+
+    assert order.get_total_price() == Decimal('20.00'), "Sharded order total is incorrect"
+    assert analytics.get_order_count() == 1, "Sharded order was not delivered to the analytics"
+    assert analytics.get_revenue_by_genre("Fiction") == Decimal('20.00'), "Sharded order revenue is incorrect"
+    assert len(orders) == 1 and orders[0].get_total_price() == Decimal('20.00'), "Sharded order was not journaled"
+    print(f"Journaled {len(orders)} sharded order")
+
+
+def test_sharded_checkout_co_purchases():
+    """Test case to verify sharded orders are indexed against the parent process's e-books."""
+
+    print("\nTesting Sharded Checkout Co-Purchases:")
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    ebook2 = EBook("E-Book Two", "Author B", datetime(2022, 2, 1), "Non-Fiction", Decimal('20.00'), "EPUB")
+    index = CoPurchaseIndex(min_count=1)
+
+    ShoppingCart.add_order_listener(index.record_order)
+    try:
+        with ShardedStore(num_shards=2) as store:
+            for number in range(3):
+                email = f"customer{number}@example.com"
+                store.add_customer(Customer(f"Customer {number}", email, "+1234567890"))
+                store.add_to_cart(email, ebook1)
+                store.add_to_cart(email, ebook2)
+                order = store.checkout(email, datetime(2024, 1, 1))
+    finally:
+        ShoppingCart.remove_order_listener(index.record_order)
+
+    assert order.get_ebooks() == [ebook1, ebook2], "Sharded order should hold the parent's e-books"
+    assert index.get_related(ebook1) == [(ebook2, 3)], "Sharded orders were not indexed against the parent's e-books"
+    assert index.get_pair_count() == 2, "Sharded orders added pairs for copied e-books"
+    print(f"Related to {ebook1.get_title()}: {index.get_related(ebook1)}")
+
+
+def test_order_journal_replays_journaled_prices():
+    """Test case to verify replay uses the journaled prices after a title is repriced."""
+
+    print("\nTesting Order Journal Replay After Repricing:")
+    catalog = Catalog()
+    ebook1 = EBook("E-Book One", "Author A", datetime(2022, 1, 1), "Fiction", Decimal('10.00'), "PDF")
+    catalog.add_item(ebook1)
+    customer = Customer("John Doe", "john.doe@example.com", "+1234567890")
+
+    with tempfile.TemporaryDirectory() as directory:
+        with OrderJournal(directory, batch_size=1) as journal:
+            shopping_cart = ShoppingCart(customer)
+            shopping_cart.add_item(ebook1, quantity=2)
+            journal.append(shopping_cart.create_order(datetime(2024, 1, 1)))
+
+        catalog.modify_item("E-Book One", price=Decimal('99.00'))
+        orders, _ = OrderJournal.replay(directory, catalog)
+
+    order = orders[0]
+    assert order.get_total_price() == Decimal('20.00'), "Replay should use the journaled prices"
+    assert [ebook.get_price() for ebook in order.get_ebooks()] == [Decimal('10.00')] * 2, "Invoice lines should keep the journaled prices"
+    assert "- E-Book One - 10.00" in order.render_invoice(), "Invoice shows the current catalog price"
+    print(order.render_invoice())
+
+
 # Run tests
 if __name__ == "__main__":
     test_catalog_operations()
     test_customer_operations()
     test_shopping_cart_operations()
     test_order_discount_application()
-    test_invoice_generation()
\ No newline at end of file
+    test_invoice_generation()
+    test_metrics_instrumentation()
+    test_checkout_tracing()
+    test_sales_analytics()
+    test_co_purchase_index()
+    test_order_journal_recovery()
+    test_order_history()
+    test_catalog_bulk_operations()
+    test_cart_totals_follow_price_changes()
+    test_cart_session_store()
+    test_categorical_interning()
+    test_sharded_store()
+    test_load_generator()
+    test_sharded_checkout_notifies_listeners()
+    test_sharded_checkout_co_purchases()
+    test_order_journal_replays_journaled_prices()
\ No newline at end of file
@@ -1,8 +1,91 @@
+import bisect
+import collections
+import contextlib
 import datetime
+import functools
+import hashlib
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+import zlib
 from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class CategoricalPool:
+    """Dictionary encoding for a categorical field such as genre or file format.
+
+    Each distinct value is stored once and given a small integer code, so the
+    many books sharing a value share one string, and equality filters can
+    compare codes instead of strings.
+    """
+
+    def __init__(self):
+        """Initializes an empty pool."""
+        self._codes = {}
+        self._values = []
+        self._lock = threading.Lock()
+
+    def encode(self, value):
+        """Returns the code of a value, adding the value to the pool if it is new.
+
+        Args:
+            value (str): The value to encode.
+
+        Returns:
+            int: The value's code.
+        """
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = self._codes[value] = len(self._values)
+                    self._values.append(value)
+        return code
+
+    def decode(self, code):
+        """Returns the value of a code.
+
+        Args:
+            code (int): A code returned by encode.
+
+        Returns:
+            str: The pooled value.
+        """
+        return self._values[code]
+
+    def lookup(self, value):
+        """Returns the code of a value without adding it, or None if it is not pooled."""
+        return self._codes.get(value)
+
+    def get_memory_size(self):
+        """Returns the approximate bytes used by the pooled values and the code table."""
+        return (sum(sys.getsizeof(value) for value in self._values)
+                + sys.getsizeof(self._codes) + sys.getsizeof(self._values))
+
+    def __len__(self):
+        """Returns the number of distinct values in the pool."""
+        return len(self._values)
+
+
+# Shared pools for the categorical fields repeated across the catalog.
+AUTHORS = CategoricalPool()
+GENRES = CategoricalPool()
+FILE_FORMATS = CategoricalPool()
+
 
 class Book:
     """Represents a book in the e-bookstore."""
+
+    # Dictionary-encoded attributes and the pool each one is encoded with.
+    _POOLED_FIELDS = (("_author_code", AUTHORS), ("_genre_code", GENRES))
   
     def __init__(self, title, author, publication_date, genre, price):
         """
@@ -16,10 +99,11 @@ class Book:
             price (Decimal or float): The price of the book.
         """
         self._title = title
-        self._author = author
+        self._author_code = AUTHORS.encode(author)
         self._publication_date = publication_date
-        self._genre = genre
+        self._genre_code = GENRES.encode(genre)
         self._price = price
+        self._price_listeners = None
 
     # Getters and Setters
     def get_title(self):
@@ -32,11 +116,11 @@ class Book:
 
     def get_author(self):
         """Returns the author of the book."""
-        return self._author
+        return AUTHORS.decode(self._author_code)
 
     def set_author(self, value):
         """Sets the author of the book."""
-        self._author = value
+        self._author_code = AUTHORS.encode(value)
 
     def get_publication_date(self):
         """Returns the publication date of the book."""
@@ -48,27 +132,75 @@ class Book:
 
     def get_genre(self):
         """Returns the genre of the book."""
-        return self._genre
+        return GENRES.decode(self._genre_code)
+
+    def get_genre_code(self):
+        """Returns the pooled integer code of the genre of the book."""
+        return self._genre_code
 
     def set_genre(self, value):
         """Sets the genre of the book."""
-        self._genre = value
+        self._genre_code = GENRES.encode(value)
 
     def get_price(self):
         """Returns the price of the book."""
         return self._price
 
     def set_price(self, value):
-        """Sets the price of the book."""
+        """Sets the price of the book and notifies the price listeners of the change."""
+        old_price = self._price
         self._price = value
+        if self._price_listeners and value != old_price:
+            for listener in list(self._price_listeners):
+                listener.on_price_change(self, old_price, value)
+
+    def add_price_listener(self, listener):
+        """Notify a listener whenever the price of the book changes.
+
+        Listeners are held weakly, so subscribing does not keep them alive.
+
+        Args:
+            listener: An object with an on_price_change(book, old_price, new_price) method.
+        """
+        if self._price_listeners is None:
+            self._price_listeners = weakref.WeakSet()
+        self._price_listeners.add(listener)
+
+    def remove_price_listener(self, listener):
+        """Stop notifying a listener of price changes.
+
+        Args:
+            listener: A listener added with add_price_listener.
+        """
+        if self._price_listeners is not None:
+            self._price_listeners.discard(listener)
+
+    def __getstate__(self):
+        """Returns the picklable state of the book, without its price listeners.
+
+        Pooled codes are only meaningful in this process, so they are replaced by their values.
+        """
+        state = self.__dict__.copy()
+        state["_price_listeners"] = None
+        for attribute, pool in self._POOLED_FIELDS:
+            state[attribute] = pool.decode(state[attribute])
+        return state
+
+    def __setstate__(self, state):
+        """Restores a pickled book, encoding its categorical values into this process's pools."""
+        for attribute, pool in self._POOLED_FIELDS:
+            state[attribute] = pool.encode(state[attribute])
+        self.__dict__.update(state)
 
     def __str__(self):
         """Returns a string representation of the book."""
-        return f"{self._title} by {self._author} ({self._genre}, {self._publication_date.year})"
+        return f"{self._title} by {self.get_author()} ({self.get_genre()}, {self._publication_date.year})"
 
 
 class EBook(Book):
     """Represents an e-book in the e-bookstore."""
+
+    _POOLED_FIELDS = Book._POOLED_FIELDS + (("_file_format_code", FILE_FORMATS),)
     
     def __init__(self, title, author, publication_date, genre, price, file_format):
         """
@@ -83,16 +215,20 @@ class EBook(Book):
             file_format (str): The file format of the e-book (e.g., PDF, EPUB).
         """
         super().__init__(title, author, publication_date, genre, price)
-        self._file_format = file_format
+        self._file_format_code = FILE_FORMATS.encode(file_format)
 
     # Getters and Setters
     def get_file_format(self):
         """Returns the file format of the e-book."""
-        return self._file_format
+        return FILE_FORMATS.decode(self._file_format_code)
+
+    def get_file_format_code(self):
+        """Returns the pooled integer code of the file format of the e-book."""
+        return self._file_format_code
 
     def set_file_format(self, value):
         """Sets the file format of the e-book."""
-        self._file_format = value
+        self._file_format_code = FILE_FORMATS.encode(value)
 
     def deliver_ebook(self):
         """Delivers the e-book to the customer."""
@@ -101,15 +237,18 @@ class EBook(Book):
     def __str__(self):
         """Returns a detailed string representation of the e-book."""
         return (f"E-Book Title: {self._title}\n"
-                f"Author: {self._author}\n"
+                f"Author: {self.get_author()}\n"
                 f"Publication Date: {self._publication_date}\n"
-                f"Genre: {self._genre}\n"
+                f"Genre: {self.get_genre()}\n"
                 f"Price: ${self._price:.2f}\n"
-                f"File Format: {self._file_format}\n")
+                f"File Format: {self.get_file_format()}\n")
 
 class Catalog:
     """Represents a catalog of available e-books."""
     
+    # Fields accepted by the bulk operations, in EBook constructor order.
+    EBOOK_FIELDS = ("author", "publication_date", "genre", "price", "file_format")
+
     def __init__(self):
         """Initializes an empty catalog."""
         self._items = []
@@ -185,6 +324,259 @@ class Catalog:
         """Returns a list of all e-books in the catalog."""
         return self._items
 
+    def filter_by_genre(self, genre):
+        """Finds every e-book of a genre, comparing pooled genre codes.
+
+        Args:
+            genre (str): The exact genre to match.
+
+        Returns:
+            list: The e-books of that genre.
+        """
+        code = GENRES.lookup(genre)
+        if code is None:
+            return []
+        return [ebook for ebook in self._items if ebook.get_genre_code() == code]
+
+    def filter_by_file_format(self, file_format):
+        """Finds every e-book in a file format, comparing pooled file format codes.
+
+        Args:
+            file_format (str): The exact file format to match, e.g. "EPUB".
+
+        Returns:
+            list: The e-books in that file format.
+        """
+        code = FILE_FORMATS.lookup(file_format)
+        if code is None:
+            return []
+        return [ebook for ebook in self._items if ebook.get_file_format_code() == code]
+
+    @staticmethod
+    def categorical_memory_report(titles=1000000, authors=50000, genres=20, file_formats=4):
+        """Measures the memory the categorical pools save on a large catalog.
+
+        Rows are generated the way a bulk loader reads them, with new string objects
+        for every row. The report compares keeping those strings on every book with
+        keeping one pooled copy of each distinct value; the per-book reference costs
+        the same either way.
+
+        Args:
+            titles (int, optional): Number of catalog rows. Defaults to 1000000.
+            authors (int, optional): Number of distinct authors. Defaults to 50000.
+            genres (int, optional): Number of distinct genres. Defaults to 20.
+            file_formats (int, optional): Number of distinct file formats. Defaults to 4.
+
+        Returns:
+            dict: The row count, distinct values per field, and the unpooled, pooled and
+                saved bytes.
+        """
+        pools = (CategoricalPool(), CategoricalPool(), CategoricalPool())
+        unpooled_bytes = 0
+        for number in range(titles):
+            row = (f"Author {number % authors}", f"Genre {number % genres}", f"Format {number % file_formats}")
+            for pool, value in zip(pools, row):
+                unpooled_bytes += sys.getsizeof(value)
+                pool.encode(value)
+        pooled_bytes = sum(pool.get_memory_size() for pool in pools)
+        return {
+            "titles": titles,
+            "distinct_authors": len(pools[0]),
+            "distinct_genres": len(pools[1]),
+            "distinct_file_formats": len(pools[2]),
+            "unpooled_bytes": unpooled_bytes,
+            "pooled_bytes": pooled_bytes,
+            "saved_bytes": unpooled_bytes - pooled_bytes,
+        }
+
+    def bulk_upsert(self, rows):
+        """Inserts or updates many e-books in one pass, keyed by title.
+
+        The batch is atomic: every row is validated before any change is made,
+        and a single invalid row leaves the catalog untouched.
+
+        Args:
+            rows (list): Dictionaries with a "title" and any of "author", "publication_date",
+                "genre", "price" and "file_format". New titles need every field, and rows
+                with any other key are rejected.
+
+        Returns:
+            list: One result per row: a dict with the "title", a "status" of "inserted",
+                "updated", "rejected" or "skipped" (valid, but the batch was rejected),
+                and a "message".
+        """
+        index = self._title_index()
+        results = []
+        inserts = []
+        updates = []
+        rejected = False
+        for row in rows:
+            title = row.get("title")
+            fields = {name: row[name] for name in self.EBOOK_FIELDS if row.get(name) is not None}
+            error = self._validate_row(row, fields, isinstance(title, str) and title.lower() in index)
+            if error:
+                results.append({"title": title, "status": "rejected", "message": error})
+                rejected = True
+                continue
+            if "price" in fields:
+                fields["price"] = Decimal(str(fields["price"]))
+            ebook = index.get(title.lower())
+            if ebook is None:
+                ebook = index[title.lower()] = EBook(title, **fields)
+                inserts.append(ebook)
+                results.append({"title": title, "status": "inserted", "message": ""})
+            else:
+                updates.append((ebook, fields))
+                results.append({"title": title, "status": "updated", "message": ""})
+
+        if rejected:
+            return self._skip_valid_rows(results)
+        for ebook, fields in updates:
+            for name, value in fields.items():
+                getattr(ebook, f"set_{name}")(value)
+        self._items.extend(inserts)
+        return results
+
+    def bulk_reprice(self, price=None, factor=None, genre=None, predicate=None):
+        """Reprices every e-book matching a genre and/or predicate in one pass.
+
+        Args:
+            price (Decimal, optional): The new price for every matching e-book.
+            factor (Decimal, optional): Multiplier applied to each current price instead,
+                rounded to cents.
+            genre (str, optional): Only reprice e-books of this genre.
+            predicate (callable, optional): Only reprice e-books for which predicate(ebook) is true.
+
+        Returns:
+            list: One result per matching e-book: a dict with the "title", a "status" of
+                "repriced", "rejected" or "skipped", the "old_price" and the "new_price".
+                Nothing is repriced if any new price would be negative or cannot be computed.
+
+        Raises:
+            ValueError: If not exactly one of price and factor is given, or it is not a finite number.
+        """
+        if (price is None) == (factor is None):
+            raise ValueError("Specify exactly one of price or factor.")
+        given = price if price is not None else factor
+        try:
+            value = Decimal(str(given))
+        except ArithmeticError:
+            value = None
+        if value is None or not value.is_finite():
+            raise ValueError(f"Invalid {'price' if price is not None else 'factor'}: {given}.")
+        genre_code = GENRES.lookup(genre) if genre is not None else None
+        if genre is not None and genre_code is None:
+            return []
+        results = []
+        changes = []
+        rejected = False
+        for ebook in self._items:
+            if genre_code is not None and ebook.get_genre_code() != genre_code:
+                continue
+            if predicate is not None and not predicate(ebook):
+                continue
+            old_price = ebook.get_price()
+            try:
+                if price is not None:
+                    new_price = value
+                else:
+                    new_price = (old_price * value).quantize(Decimal('0.01'))
+                if not new_price.is_finite():
+                    error = f"Invalid price: {new_price}."
+                elif new_price < 0:
+                    error = "Price cannot be negative."
+                else:
+                    error = ""
+            except (ArithmeticError, TypeError):
+                new_price = None
+                error = f"Cannot reprice from {old_price!r}."
+            result = {"title": ebook.get_title(), "status": "repriced", "message": error,
+                      "old_price": old_price, "new_price": new_price}
+            if error:
+                result["status"] = "rejected"
+                rejected = True
+            results.append(result)
+            changes.append((ebook, new_price))
+
+        if rejected:
+            return self._skip_valid_rows(results)
+        for ebook, new_price in changes:
+            ebook.set_price(new_price)
+        return results
+
+    def bulk_remove(self, titles):
+        """Removes many e-books by title in one pass over the catalog.
+
+        Titles are matched case-insensitively, like find_by_title and bulk_upsert.
+
+        Args:
+            titles (list): The titles of the e-books to remove.
+
+        Returns:
+            list: One result per title: a dict with the "title" and a "status" of
+                "removed" or "not found".
+        """
+        wanted = {title.lower() for title in titles}
+        removed = set()
+        new_items = []
+        for ebook in self._items:
+            key = ebook.get_title().lower()
+            if key in wanted:
+                removed.add(key)
+            else:
+                new_items.append(ebook)
+        self._items = new_items
+        return [{"title": title, "status": "removed" if title.lower() in removed else "not found"}
+                for title in titles]
+
+    def _title_index(self):
+        """Builds a lowercase title lookup for a batch, matching find_by_title."""
+        index = {}
+        for ebook in self._items:
+            index.setdefault(ebook.get_title().lower(), ebook)
+        return index
+
+    def _validate_row(self, row, fields, exists):
+        """Returns why an upsert row is invalid, or an empty string if it is valid.
+
+        Every field is checked here, so applying a valid batch cannot fail partway.
+        """
+        title = row.get("title")
+        if not title:
+            return "Missing title."
+        if not isinstance(title, str):
+            return f"Title must be a string: {title!r}."
+        unknown = sorted(name for name in row if name != "title" and name not in self.EBOOK_FIELDS)
+        if unknown:
+            return f"Unknown field: {', '.join(unknown)}."
+        if not exists:
+            missing = [name for name in self.EBOOK_FIELDS if name not in fields]
+            if missing:
+                return f"New e-book is missing: {', '.join(missing)}."
+        for name in ("author", "genre", "file_format"):
+            if name in fields and not isinstance(fields[name], str):
+                return f"{name.replace('_', ' ').capitalize()} must be a string: {fields[name]!r}."
+        if "publication_date" in fields and not isinstance(fields["publication_date"], datetime.date):
+            return f"Publication date must be a date: {fields['publication_date']!r}."
+        if "price" in fields:
+            try:
+                price = Decimal(str(fields["price"]))
+            except ArithmeticError:
+                return f"Invalid price: {fields['price']}."
+            if not price.is_finite():
+                return f"Invalid price: {fields['price']}."
+            if price < 0:
+                return "Price cannot be negative."
+        return ""
+
+    def _skip_valid_rows(self, results):
+        """Marks the valid rows of a rejected batch as skipped."""
+        for result in results:
+            if result["status"] != "rejected":
+                result["status"] = "skipped"
+                result["message"] = "Batch rejected."
+        return results
+
     def __repr__(self):
         """Returns a string representation of the catalog."""
         return f"EBookCatalog with {len(self._items)} e-books"
@@ -368,6 +760,9 @@ class CustomerList:
 class ShoppingCart:
     """Represents a customer's shopping cart."""
 
+    # Callables notified with every order created from any cart.
+    _order_listeners = []
+
     def __init__(self, customer):
         """Initializes the ShoppingCart with the associated customer.
 
@@ -377,6 +772,7 @@ class ShoppingCart:
         self._customer = customer
         self._items = []
         self._total_price = Decimal('0.00')
+        self._size_listener = None
 
     # Getters and setters
     def get_customer(self):
@@ -401,7 +797,12 @@ class ShoppingCart:
         Args:
             items (list): The items to set in the cart.
         """
+        for ebook, _ in self._items:
+            ebook.remove_price_listener(self)
         self._items = items
+        for ebook, _ in self._items:
+            ebook.add_price_listener(self)
+        self._notify_size_listener()
 
     def get_total_price(self):
         """Returns the total price of items in the shopping cart."""
@@ -424,6 +825,8 @@ class ShoppingCart:
         """
         self._items.append((ebook, quantity))
         self._total_price += ebook.get_price() * quantity
+        ebook.add_price_listener(self)
+        self._notify_size_listener()
 
     def apply_loyalty_discount(self):
         """Apply a loyalty discount if applicable."""
@@ -440,7 +843,10 @@ class ShoppingCart:
             if item[0] == ebook:
                 self._items.remove(item)
                 self._total_price -= ebook.get_price() * item[1]
+                self._notify_size_listener()
                 break
+        if not any(existing_item[0] == ebook for existing_item in self._items):
+            ebook.remove_price_listener(self)
 
     def update_quantity(self, ebook, quantity):
         """Update the quantity of an e-book in the shopping cart.
@@ -460,13 +866,41 @@ class ShoppingCart:
             self._items.remove(item)
         self._items.append((ebook, quantity))
         self._total_price += ebook.get_price() * quantity
+        ebook.add_price_listener(self)
+        if not item:
+            self._notify_size_listener()
+
+    def set_size_listener(self, listener):
+        """Notify a listener whenever the number of lines in the cart changes.
+
+        Args:
+            listener (callable): Called with the cart after each change, or None to stop notifying.
+        """
+        self._size_listener = listener
+
+    def _notify_size_listener(self):
+        """Calls the size listener, if any."""
+        if self._size_listener is not None:
+            self._size_listener(self)
 
-    def create_order(self, order_date, vat_rate=Decimal('0.08')):
+    def on_price_change(self, ebook, old_price, new_price):
+        """Adjust the total price when the price of an e-book in the cart changes.
+
+        Args:
+            ebook (EBook): The repriced e-book.
+            old_price (Decimal): The previous price.
+            new_price (Decimal): The new price.
+        """
+        quantity = sum(item[1] for item in self._items if item[0] == ebook)
+        self._total_price += (new_price - old_price) * quantity
+
+    def create_order(self, order_date, vat_rate=Decimal('0.08'), order_history=None):
         """Create an Order from the shopping cart items.
 
         Args:
             order_date (datetime): The date of the order.
             vat_rate (Decimal, optional): The VAT rate to apply. Defaults to 8%.
+            order_history (OrderHistory, optional): Purchase history used for loyalty decisions.
 
         Returns:
             Order: The created order or a message if the cart is empty.
@@ -474,12 +908,49 @@ class ShoppingCart:
         if not self._items:
             return f"{self._customer.get_name()}'s Shopping Cart is empty."
 
-        order = Order(order_date, self._customer)
+        order = Order(order_date, self._customer, order_history=order_history)
         for ebook, quantity in self._items:
             for _ in range(quantity):
                 order.add_ebook(ebook)
+        ShoppingCart.notify_order_listeners(order)
         return order
 
+    @classmethod
+    def add_order_listener(cls, listener):
+        """Subscribe to the orders created by every shopping cart.
+
+        Args:
+            listener (callable): Called with each new Order as it is created.
+        """
+        if listener not in cls._order_listeners:
+            cls._order_listeners.append(listener)
+
+    @classmethod
+    def notify_order_listeners(cls, order):
+        """Deliver an order to every listener added with add_order_listener.
+
+        Args:
+            order (Order): The newly created order.
+        """
+        for listener in list(cls._order_listeners):
+            listener(order)
+
+    @classmethod
+    def remove_order_listener(cls, listener):
+        """Unsubscribe a listener added with add_order_listener.
+
+        Args:
+            listener (callable): The listener to remove.
+        """
+        if listener in cls._order_listeners:
+            cls._order_listeners.remove(listener)
+
+    def __getstate__(self):
+        """Returns the picklable state of the cart, without its size listener."""
+        state = self.__dict__.copy()
+        state["_size_listener"] = None
+        return state
+
     def __str__(self):
         """Returns a string representation of the shopping cart."""
         if not self._items:
@@ -498,7 +969,7 @@ class ShoppingCart:
 class Order:
     """Represents a customer order with discount capabilities."""
   
-    def __init__(self, order_date, customer, vat_rate=Decimal('0.08'), loyalty_discount=Decimal('0.1'), bulk_discount=Decimal('0.2')):
+    def __init__(self, order_date, customer, vat_rate=Decimal('0.08'), loyalty_discount=Decimal('0.1'), bulk_discount=Decimal('0.2'), order_history=None):
         """Initializes the Order with the specified date, customer, and discount rates.
 
         Args:
@@ -507,6 +978,9 @@ class Order:
             vat_rate (Decimal, optional): The VAT rate. Defaults to 0.08 (8%).
             loyalty_discount (Decimal, optional): The loyalty discount rate. Defaults to 0.1 (10%).
             bulk_discount (Decimal, optional): The bulk discount rate. Defaults to 0.2 (20%).
+            order_history (OrderHistory, optional): Purchase history that also qualifies the
+                customer for the loyalty discount. Eligibility is decided once, here, so
+                orders recorded later do not change it. Defaults to None.
         """
         self._order_date = order_date
         self._customer = customer
@@ -515,6 +989,8 @@ class Order:
         self._ebooks = []
         self._loyalty_discount = Decimal(loyalty_discount)
         self._bulk_discount = Decimal(bulk_discount)
+        self._loyal_by_history = (order_history is not None
+                                  and order_history.is_loyal_customer(customer, order_date))
 
     # Getters and setters
     def get_order_date(self):
@@ -629,6 +1105,14 @@ class Order:
         """
         self._bulk_discount = bulk_discount
 
+    def is_loyal_by_history(self):
+        """Returns True if the purchase history qualified the order for the loyalty discount.
+
+        Returns:
+            bool: Whether the customer had enough earlier orders when this order was created.
+        """
+        return self._loyal_by_history
+
     def add_ebook(self, ebook):
         """Add an e-book to the order and update the total price.
 
@@ -641,30 +1125,50 @@ class Order:
     def apply_discounts(self):
         """Apply discounts to the total price of the order.
 
+        The loyalty discount applies if the customer has loyalty points or had enough
+        earlier orders in the order history when the order was created.
+
         Returns:
             Decimal: The discounted price after applying loyalty and bulk discounts.
         """
         discounted_price = self._total_price
         if len(self._ebooks) >= 5:
             discounted_price *= (1 - self._bulk_discount)
-        if self._customer.get_loyalty_points() > 0:
+        if self._customer.get_loyalty_points() > 0 or self._loyal_by_history:
             discounted_price *= (1 - self._loyalty_discount)
         return discounted_price
 
-    def generate_invoice(self):
-        """Generate an invoice for the order and print it to the console."""
-        print("Order Invoice:")
-        print(f"Order Date: {self._order_date.strftime('%Y-%m-%d')}")
-        print("Items:")
+    def get_vat_amount(self):
+        """Returns the VAT due on the order subtotal.
+
+        Returns:
+            Decimal: The VAT amount.
+        """
+        return self._total_price * self._vat_rate
+
+    def render_invoice(self):
+        """Render the invoice for the order.
+
+        Returns:
+            str: The invoice text printed by generate_invoice.
+        """
+        lines = ["Order Invoice:",
+                 f"Order Date: {self._order_date.strftime('%Y-%m-%d')}",
+                 "Items:"]
         for ebook in self._ebooks:
-            print(f"- {ebook.get_title()} - {ebook.get_price():.2f}")
-        print(f"Subtotal: {self._total_price:.2f}")
-        vat_amount = self._total_price * self._vat_rate
-        print(f"VAT ({self._vat_rate * 100}%): {vat_amount:.2f}")
-        
+            lines.append(f"- {ebook.get_title()} - {ebook.get_price():.2f}")
+        lines.append(f"Subtotal: {self._total_price:.2f}")
+        vat_amount = self.get_vat_amount()
+        lines.append(f"VAT ({self._vat_rate * 100}%): {vat_amount:.2f}")
+
         # Calculate total after discounts
         grand_total = self.apply_discounts() + vat_amount
-        print(f"Total: {grand_total:.2f}")
+        lines.append(f"Total: {grand_total:.2f}")
+        return "\n".join(lines)
+
+    def generate_invoice(self):
+        """Generate an invoice for the order and print it to the console."""
+        print(self.render_invoice())
 
     def __str__(self):
         """Returns a string representation of the order invoice, including items, subtotal, VAT, and total after discounts.
@@ -677,7 +1181,7 @@ class Order:
             items_summary_list.append(f"- {ebook.get_title()} - Price: {ebook.get_price():.2f}")
         
         items_summary = "\n".join(items_summary_list)
-        vat_amount = self._total_price * self._vat_rate
+        vat_amount = self.get_vat_amount()
         grand_total = self.apply_discounts() + vat_amount
         
         return (f"Order Invoice:\n"
@@ -687,3 +1191,1998 @@ class Order:
                 f"Subtotal: {self._total_price:.2f}\n"
                 f"VAT ({self._vat_rate * 100}%): {vat_amount:.2f}\n"
                 f"Total after discounts: {grand_total:.2f}")
+
+
+class Metrics:
+    """Collects call counts, latency histograms and collection sizes for the e-bookstore classes.
+
+    Instrumentation is opt-in. While it is disabled the classes keep their plain,
+    unwrapped methods, so the hot paths pay nothing for it.
+    """
+
+    LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                       0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, buckets=None):
+        """Initializes an empty, disabled metrics registry.
+
+        Args:
+            buckets (tuple, optional): Upper bounds of the latency histogram buckets in seconds.
+                Defaults to LATENCY_BUCKETS.
+        """
+        self._buckets = tuple(buckets) if buckets is not None else self.LATENCY_BUCKETS
+        self._lock = threading.Lock()
+        self._enabled = False
+        self.reset()
+
+    def is_enabled(self):
+        """Returns True if the instrumentation is currently installed."""
+        return self._enabled
+
+    def enable(self):
+        """Installs the instrumentation wrappers on the e-bookstore classes."""
+        if not self._enabled:
+            self._enabled = True
+            _active_instrumentation.append(self)
+            _rewire_methods()
+
+    def disable(self):
+        """Removes the instrumentation wrappers, restoring the original methods."""
+        if self._enabled:
+            self._enabled = False
+            _active_instrumentation.remove(self)
+            _rewire_methods()
+
+    def reset(self):
+        """Discards every recorded measurement."""
+        with self._lock:
+            self._calls = {}
+            self._bucket_counts = {}
+            self._latency_sums = {}
+            self._sizes = {}
+            self._max_sizes = {}
+
+    def wrap(self, cls, name, method):
+        """Returns a version of a method that records its calls into this registry.
+
+        Args:
+            cls (type): The class owning the method.
+            name (str): The method name.
+            method (function): The function to wrap.
+
+        Returns:
+            function: The instrumented function.
+        """
+        key = f"{cls.__name__}.{name}"
+        collection = cls.__name__
+        attribute = _COLLECTION_ATTRIBUTES[cls]
+        observe = self.observe
+
+        @functools.wraps(method)
+        def instrumented(instance, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(instance, *args, **kwargs)
+            finally:
+                observe(key, time.perf_counter() - start, collection, len(getattr(instance, attribute)))
+        return instrumented
+
+    def observe(self, method, duration, collection, size):
+        """Records a single method call.
+
+        Args:
+            method (str): The qualified method name, e.g. "Catalog.add_item".
+            duration (float): The call latency in seconds.
+            collection (str): The name of the collection the method works on.
+            size (int): The size of that collection after the call.
+        """
+        index = bisect.bisect_left(self._buckets, duration)
+        with self._lock:
+            self._calls[method] = self._calls.get(method, 0) + 1
+            counts = self._bucket_counts.get(method)
+            if counts is None:
+                counts = self._bucket_counts[method] = [0] * (len(self._buckets) + 1)
+            counts[index] += 1
+            self._latency_sums[method] = self._latency_sums.get(method, 0.0) + duration
+            self._sizes[collection] = size
+            if size > self._max_sizes.get(collection, -1):
+                self._max_sizes[collection] = size
+
+    def snapshot(self):
+        """Returns a copy of all recorded metrics.
+
+        Returns:
+            dict: The call counts, latency histograms (with cumulative bucket counts)
+                and the last and maximum observed collection sizes.
+        """
+        with self._lock:
+            latency = {}
+            for method, counts in self._bucket_counts.items():
+                cumulative = []
+                running = 0
+                for count in counts:
+                    running += count
+                    cumulative.append(running)
+                latency[method] = {
+                    "count": self._calls[method],
+                    "sum": self._latency_sums[method],
+                    "buckets": dict(zip(self._buckets + (float("inf"),), cumulative)),
+                }
+            return {
+                "calls": dict(self._calls),
+                "latency": latency,
+                "collection_sizes": dict(self._sizes),
+                "collection_size_max": dict(self._max_sizes),
+            }
+
+    def to_prometheus(self):
+        """Renders the recorded metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics text.
+        """
+        snapshot = self.snapshot()
+        lines = ["# HELP ebookstore_calls_total Number of calls per e-bookstore method.",
+                 "# TYPE ebookstore_calls_total counter"]
+        for method, count in sorted(snapshot["calls"].items()):
+            lines.append(f'ebookstore_calls_total{{method="{method}"}} {count}')
+
+        lines.append("# HELP ebookstore_call_duration_seconds Latency of e-bookstore method calls.")
+        lines.append("# TYPE ebookstore_call_duration_seconds histogram")
+        for method, histogram in sorted(snapshot["latency"].items()):
+            for bound, count in histogram["buckets"].items():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'ebookstore_call_duration_seconds_bucket{{method="{method}",le="{le}"}} {count}')
+            lines.append(f'ebookstore_call_duration_seconds_sum{{method="{method}"}} {histogram["sum"]!r}')
+            lines.append(f'ebookstore_call_duration_seconds_count{{method="{method}"}} {histogram["count"]}')
+
+        lines.append("# HELP ebookstore_collection_size Last observed size of each collection.")
+        lines.append("# TYPE ebookstore_collection_size gauge")
+        for collection, size in sorted(snapshot["collection_sizes"].items()):
+            lines.append(f'ebookstore_collection_size{{collection="{collection}"}} {size}')
+
+        lines.append("# HELP ebookstore_collection_size_max Largest observed size of each collection.")
+        lines.append("# TYPE ebookstore_collection_size_max gauge")
+        for collection, size in sorted(snapshot["collection_size_max"].items()):
+            lines.append(f'ebookstore_collection_size_max{{collection="{collection}"}} {size}')
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self, path):
+        """Writes the metrics to a file, e.g. for the node exporter textfile collector.
+
+        The file is replaced atomically so a scraper never reads a partial export.
+
+        Args:
+            path (str): The destination file path.
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def serve_prometheus(self, port=9464, host="127.0.0.1"):
+        """Serves the metrics over HTTP at /metrics from a background thread.
+
+        Args:
+            port (int, optional): The port to listen on. Use 0 to pick a free port. Defaults to 9464.
+            host (str, optional): The address to bind. Defaults to 127.0.0.1.
+
+        Returns:
+            ThreadingHTTPServer: The running server; call shutdown() to stop it.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Methods that opt-in instrumentation may wrap, and the collection each class manages.
+_INSTRUMENTED_METHODS = {
+    Catalog: ("add_item", "modify_item", "remove_item", "find_by_title"),
+    CustomerList: ("add_customer", "modify_customer", "remove_customer"),
+    ShoppingCart: ("add_item", "remove_item", "update_quantity", "create_order"),
+    Order: ("add_ebook", "apply_discounts", "get_vat_amount", "render_invoice", "generate_invoice"),
+}
+_COLLECTION_ATTRIBUTES = {
+    Catalog: "_items",
+    CustomerList: "_customers",
+    ShoppingCart: "_items",
+    Order: "_ebooks",
+}
+_ORIGINAL_METHODS = {}
+_active_instrumentation = []
+
+
+def _rewire_methods():
+    """Rebuilds every instrumented method from the original, applying the active instrumentation in order."""
+    for cls, names in _INSTRUMENTED_METHODS.items():
+        for name in names:
+            method = _ORIGINAL_METHODS.setdefault((cls, name), cls.__dict__[name])
+            for instrumentation in _active_instrumentation:
+                method = instrumentation.wrap(cls, name, method)
+            setattr(cls, name, method)
+
+
+METRICS = Metrics()
+
+
+class Tracer:
+    """Records parent/child timing spans across the checkout flow.
+
+    Spans are written as JSON lines in the Chrome trace event format ("ph": "X"
+    complete events), which Perfetto and chrome://tracing can load once the lines
+    are wrapped in a JSON array. The sampling decision is made once per root span
+    and inherited by its children, so an unsampled checkout records nothing.
+    """
+
+    def __init__(self, path=None, sample_rate=1.0, max_buffered_spans=1000):
+        """Initializes a disabled tracer.
+
+        Args:
+            path (str, optional): The JSONL file that finished spans are appended to.
+                Without a path only the most recent spans are kept in memory.
+            sample_rate (float, optional): Fraction of root spans to record. Defaults to 1.0.
+            max_buffered_spans (int, optional): Number of spans buffered before they are
+                written to the file, and the number kept for get_spans(). Defaults to 1000.
+        """
+        self._path = path
+        self._sample_rate = sample_rate
+        self._max_buffered_spans = max_buffered_spans
+        self._enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._random = random.Random()
+        self._pending = []
+        self._recent = collections.deque(maxlen=max_buffered_spans)
+
+    def get_path(self):
+        """Returns the JSONL file spans are exported to."""
+        return self._path
+
+    def set_path(self, path):
+        """Sets the JSONL file spans are exported to, flushing any spans buffered for the old one."""
+        self.flush()
+        self._path = path
+
+    def get_sample_rate(self):
+        """Returns the fraction of root spans that are recorded."""
+        return self._sample_rate
+
+    def set_sample_rate(self, sample_rate):
+        """Sets the fraction of root spans that are recorded, between 0.0 and 1.0."""
+        self._sample_rate = min(1.0, max(0.0, sample_rate))
+
+    def is_enabled(self):
+        """Returns True if the checkout methods are currently traced."""
+        return self._enabled
+
+    def enable(self):
+        """Installs tracing on the checkout methods."""
+        if not self._enabled:
+            self._enabled = True
+            _active_instrumentation.append(self)
+            _rewire_methods()
+
+    def disable(self):
+        """Removes tracing from the checkout methods and flushes buffered spans."""
+        if self._enabled:
+            self._enabled = False
+            _active_instrumentation.remove(self)
+            _rewire_methods()
+        self.flush()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times a block of code as a span, nested under the currently open span.
+
+        Args:
+            name (str): The span name, e.g. "checkout".
+            **attributes: Extra values recorded with the span.
+
+        Yields:
+            dict or None: The span being recorded, or None if the trace is not sampled.
+        """
+        local = self._local
+        stack = getattr(local, "stack", None)
+        if stack is None:
+            stack = local.stack = []
+            local.unsampled_depth = 0
+        if local.unsampled_depth or (not stack and self._random.random() >= self._sample_rate):
+            local.unsampled_depth += 1
+            try:
+                yield None
+            finally:
+                local.unsampled_depth -= 1
+            return
+
+        parent = stack[-1] if stack else None
+        span = {
+            "name": name,
+            "trace_id": parent["trace_id"] if parent else f"{self._random.getrandbits(128):032x}",
+            "span_id": f"{self._random.getrandbits(64):016x}",
+            "parent_id": parent["span_id"] if parent else None,
+            "attributes": attributes,
+        }
+        stack.append(span)
+        timestamp = time.time_ns() // 1000
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            self._record({
+                "name": name,
+                "cat": "ebookstore",
+                "ph": "X",
+                "ts": timestamp,
+                "dur": round(duration * 1_000_000, 3),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": dict(span["attributes"], trace_id=span["trace_id"],
+                             span_id=span["span_id"], parent_id=span["parent_id"]),
+            })
+
+    def wrap(self, cls, name, method):
+        """Returns a version of a checkout method that runs inside a span.
+
+        Args:
+            cls (type): The class owning the method.
+            name (str): The method name.
+            method (function): The function to wrap.
+
+        Returns:
+            function: The traced function, or the method itself if it is not part of checkout.
+        """
+        span_name = _TRACED_METHODS.get((cls, name))
+        if span_name is None:
+            return method
+        span = self.span
+
+        @functools.wraps(method)
+        def traced(instance, *args, **kwargs):
+            with span(span_name):
+                return method(instance, *args, **kwargs)
+        return traced
+
+    def get_spans(self):
+        """Returns the most recently finished spans as trace events.
+
+        Returns:
+            list: Up to max_buffered_spans trace event dictionaries, oldest first.
+        """
+        with self._lock:
+            return list(self._recent)
+
+    def flush(self):
+        """Appends the buffered spans to the export file."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending or self._path is None:
+                return
+            with open(self._path, "a", encoding="utf-8") as file:
+                file.writelines(json.dumps(event, default=str) + "\n" for event in pending)
+
+    def _record(self, event):
+        """Buffers a finished span, writing the buffer out once it is full."""
+        with self._lock:
+            self._recent.append(event)
+            if self._path is None:
+                return
+            self._pending.append(event)
+            full = len(self._pending) >= self._max_buffered_spans
+        if full:
+            self.flush()
+
+
+# Span names for the checkout methods: cart mutation -> order creation -> discounts -> VAT -> invoice.
+_TRACED_METHODS = {
+    (ShoppingCart, "add_item"): "cart.add_item",
+    (ShoppingCart, "remove_item"): "cart.remove_item",
+    (ShoppingCart, "update_quantity"): "cart.update_quantity",
+    (ShoppingCart, "create_order"): "order.create",
+    (Order, "apply_discounts"): "order.apply_discounts",
+    (Order, "get_vat_amount"): "order.vat",
+    (Order, "render_invoice"): "invoice.render",
+    (Order, "generate_invoice"): "invoice.generate",
+}
+
+TRACER = Tracer()
+
+
+class CountMinSketch:
+    """Approximate frequency counts in fixed memory.
+
+    Estimates never undercount; they overcount by at most about 2/width of the
+    total count with probability 1 - 0.5 ** depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        """Initializes an empty sketch.
+
+        Args:
+            width (int, optional): Counters per row. Defaults to 2048.
+            depth (int, optional): Number of independent rows. Defaults to 4.
+        """
+        self._width = width
+        self._depth = depth
+        self._rows = [[0] * width for _ in range(depth)]
+
+    def add(self, key, count=1):
+        """Adds occurrences of a key.
+
+        Args:
+            key (hashable): The key to count.
+            count (int, optional): The number of occurrences. Defaults to 1.
+
+        Returns:
+            int: The new estimated count of the key.
+        """
+        estimate = None
+        for seed, row in enumerate(self._rows):
+            index = hash((seed, key)) % self._width
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        """Returns the estimated count of a key.
+
+        Args:
+            key (hashable): The key to look up.
+
+        Returns:
+            int: The estimated count, never lower than the true count.
+        """
+        return min(row[hash((seed, key)) % self._width] for seed, row in enumerate(self._rows))
+
+
+class SalesAnalytics:
+    """Maintains sales aggregates incrementally as orders are created.
+
+    Register it with ShoppingCart.add_order_listener(analytics.record_order) and
+    every dashboard figure becomes a dictionary lookup instead of a scan over all
+    stored orders. Revenue is the e-book list price, before discounts and VAT.
+    """
+
+    def __init__(self, top_k=10, window_days=None, sketch_width=2048, sketch_depth=4):
+        """Initializes empty aggregates.
+
+        Args:
+            top_k (int, optional): Number of bestsellers to track. Defaults to 10.
+            window_days (int, optional): Number of most recent days of daily sales to keep.
+                Defaults to None, which keeps every day.
+            sketch_width (int, optional): Width of the count-min sketch. Defaults to 2048.
+            sketch_depth (int, optional): Depth of the count-min sketch. Defaults to 4.
+        """
+        self._top_k = top_k
+        self._window_days = window_days
+        self._lock = threading.Lock()
+        self._order_count = 0
+        self._total_revenue = Decimal('0.00')
+        self._by_genre = {}
+        self._by_author = {}
+        self._by_file_format = {}
+        self._daily = {}
+        self._days_heap = []
+        self._latest_day = None
+        self._sketch = CountMinSketch(sketch_width, sketch_depth)
+        self._top_sellers = {}
+        self._top_heap = []
+
+    def record_order(self, order):
+        """Adds an order to every aggregate.
+
+        Args:
+            order (Order): The newly created order.
+        """
+        order_date = order.get_order_date()
+        day = order_date.date() if isinstance(order_date, datetime.datetime) else order_date
+        copies = collections.Counter()
+        with self._lock:
+            self._order_count += 1
+            daily = self._daily.get(day)
+            if daily is None:
+                daily = self._daily[day] = [Decimal('0.00'), 0, 0]
+                heapq.heappush(self._days_heap, day)
+            daily[2] += 1
+            for ebook in order.get_ebooks():
+                price = ebook.get_price()
+                self._total_revenue += price
+                daily[0] += price
+                daily[1] += 1
+                self._add_sale(self._by_genre, ebook.get_genre(), price)
+                self._add_sale(self._by_author, ebook.get_author(), price)
+                self._add_sale(self._by_file_format, ebook.get_file_format(), price)
+                copies[ebook.get_title()] += 1
+            for title, count in copies.items():
+                self._update_top_sellers(title, self._sketch.add(title, count))
+            if self._latest_day is None or day > self._latest_day:
+                self._latest_day = day
+            self._expire_days()
+
+    def get_order_count(self):
+        """Returns the number of orders recorded."""
+        return self._order_count
+
+    def get_total_revenue(self):
+        """Returns the revenue of all recorded orders."""
+        return self._total_revenue
+
+    def get_revenue_by_genre(self, genre=None):
+        """Returns the revenue of one genre, or of every genre.
+
+        Args:
+            genre (str, optional): The genre to look up.
+
+        Returns:
+            Decimal or dict: The genre's revenue, or a mapping of every genre to its revenue.
+        """
+        return self._get_revenue(self._by_genre, genre)
+
+    def get_revenue_by_author(self, author=None):
+        """Returns the revenue of one author, or of every author.
+
+        Args:
+            author (str, optional): The author to look up.
+
+        Returns:
+            Decimal or dict: The author's revenue, or a mapping of every author to its revenue.
+        """
+        return self._get_revenue(self._by_author, author)
+
+    def get_revenue_by_file_format(self, file_format=None):
+        """Returns the revenue of one file format, or of every file format.
+
+        Args:
+            file_format (str, optional): The file format to look up.
+
+        Returns:
+            Decimal or dict: The format's revenue, or a mapping of every format to its revenue.
+        """
+        return self._get_revenue(self._by_file_format, file_format)
+
+    def get_units_by_genre(self, genre):
+        """Returns the number of copies sold in a genre."""
+        return self._by_genre.get(genre, (None, 0))[1]
+
+    def get_daily_sales(self, day):
+        """Returns the sales of a single day.
+
+        Args:
+            day (datetime.date): The day to look up.
+
+        Returns:
+            dict: The day's revenue, copies sold and order count.
+        """
+        revenue, units, orders = self._daily.get(day, (Decimal('0.00'), 0, 0))
+        return {"revenue": revenue, "units": units, "orders": orders}
+
+    def get_top_sellers(self):
+        """Returns the bestselling titles.
+
+        Counts come from the count-min sketch, so they may slightly overestimate.
+
+        Returns:
+            list: Up to top_k (title, estimated copies sold) tuples, best first.
+        """
+        with self._lock:
+            return sorted(self._top_sellers.items(), key=lambda item: (-item[1], item[0]))
+
+    def _add_sale(self, aggregate, key, price):
+        """Adds one sold copy to a per-key revenue and units aggregate."""
+        totals = aggregate.get(key)
+        if totals is None:
+            aggregate[key] = [price, 1]
+        else:
+            totals[0] += price
+            totals[1] += 1
+
+    def _get_revenue(self, aggregate, key):
+        """Returns the revenue of one key, or a copy of the whole aggregate."""
+        if key is not None:
+            return aggregate.get(key, (Decimal('0.00'), 0))[0]
+        with self._lock:
+            return {name: totals[0] for name, totals in aggregate.items()}
+
+    def _update_top_sellers(self, title, estimate):
+        """Keeps the top_k titles by estimated count, using a min-heap with lazy deletion."""
+        if title not in self._top_sellers and len(self._top_sellers) >= self._top_k:
+            while self._top_heap and self._top_sellers.get(self._top_heap[0][1]) != self._top_heap[0][0]:
+                heapq.heappop(self._top_heap)
+            if not self._top_heap or estimate <= self._top_heap[0][0]:
+                return
+            del self._top_sellers[heapq.heappop(self._top_heap)[1]]
+        self._top_sellers[title] = estimate
+        heapq.heappush(self._top_heap, (estimate, title))
+        if len(self._top_heap) > 4 * self._top_k:
+            self._top_heap = [(count, name) for name, count in self._top_sellers.items()]
+            heapq.heapify(self._top_heap)
+
+    def _expire_days(self):
+        """Drops daily sales older than the rolling window."""
+        if self._window_days is None:
+            return
+        cutoff = self._latest_day - datetime.timedelta(days=self._window_days - 1)
+        while self._days_heap and self._days_heap[0] < cutoff:
+            del self._daily[heapq.heappop(self._days_heap)]
+
+
+class CoPurchaseIndex:
+    """Sparse "customers also bought" index over the e-books ordered together.
+
+    Register it with ShoppingCart.add_order_listener(index.record_order). Each
+    order updates the pair counts of its distinct e-books in O(items ** 2), and
+    related titles are served from a per-book cache of the sorted neighbours.
+    """
+
+    def __init__(self, min_count=2, max_related=50, compact_every=10000):
+        """Initializes an empty index.
+
+        Args:
+            min_count (int, optional): Pairs seen fewer times are dropped on compaction. Defaults to 2.
+            max_related (int, optional): Neighbours kept per e-book after compaction. Defaults to 50.
+            compact_every (int, optional): Orders between automatic compactions, or None to
+                only compact when compact() is called. Defaults to 10000.
+        """
+        self._min_count = min_count
+        self._max_related = max_related
+        self._compact_every = compact_every
+        self._lock = threading.Lock()
+        self._pairs = {}
+        self._related_cache = {}
+        self._orders_since_compaction = 0
+
+    def record_order(self, order):
+        """Counts every pair of distinct e-books in an order.
+
+        Args:
+            order (Order): The newly created order.
+        """
+        ebooks = list(dict.fromkeys(order.get_ebooks()))
+        if len(ebooks) < 2:
+            return
+        with self._lock:
+            for ebook in ebooks:
+                related = self._pairs.get(ebook)
+                if related is None:
+                    related = self._pairs[ebook] = {}
+                for other in ebooks:
+                    if other is not ebook:
+                        related[other] = related.get(other, 0) + 1
+                if len(related) > 2 * self._max_related:
+                    self._trim(related)
+                self._related_cache.pop(ebook, None)
+            self._orders_since_compaction += 1
+            if self._compact_every is not None and self._orders_since_compaction >= self._compact_every:
+                self._compact()
+
+    def get_related(self, ebook, n=5):
+        """Returns the e-books most often bought together with an e-book.
+
+        Args:
+            ebook (EBook): The e-book to find related titles for.
+            n (int, optional): The maximum number of titles to return. Defaults to 5.
+
+        Returns:
+            list: Up to n (EBook, times bought together) tuples, most frequent first.
+        """
+        ranked = self._related_cache.get(ebook)
+        if ranked is None:
+            with self._lock:
+                related = self._pairs.get(ebook, {})
+                ranked = sorted(related.items(), key=lambda item: (-item[1], item[0].get_title()))
+                self._related_cache[ebook] = ranked
+        return ranked[:n]
+
+    def get_pair_count(self):
+        """Returns the number of stored (e-book, related e-book) pairs."""
+        return sum(len(related) for related in self._pairs.values())
+
+    def compact(self):
+        """Drops rare pairs and caps the neighbours kept for each e-book."""
+        with self._lock:
+            self._compact()
+
+    def save(self, path):
+        """Writes the index to a JSON file, keyed by title.
+
+        Args:
+            path (str): The destination file path.
+        """
+        with self._lock:
+            pairs = {
+                ebook.get_title(): {other.get_title(): count for other, count in related.items()}
+                for ebook, related in self._pairs.items()
+            }
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"min_count": self._min_count, "max_related": self._max_related, "pairs": pairs}, file)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, catalog, compact_every=10000):
+        """Reads an index written by save(), resolving titles against a catalog.
+
+        Titles that are no longer in the catalog are skipped.
+
+        Args:
+            path (str): The file to read.
+            catalog (Catalog): The catalog holding the e-books.
+            compact_every (int, optional): Orders between automatic compactions. Defaults to 10000.
+
+        Returns:
+            CoPurchaseIndex: The restored index.
+        """
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        index = cls(data["min_count"], data["max_related"], compact_every)
+        ebooks = {ebook.get_title(): ebook for ebook in catalog.list_items()}
+        for title, related_titles in data["pairs"].items():
+            ebook = ebooks.get(title)
+            if ebook is None:
+                continue
+            related = {ebooks[other]: count for other, count in related_titles.items() if other in ebooks}
+            if related:
+                index._pairs[ebook] = related
+        return index
+
+    def _compact(self):
+        """Drops rare pairs and trims neighbours; the caller holds the lock."""
+        for ebook in list(self._pairs):
+            related = {other: count for other, count in self._pairs[ebook].items() if count >= self._min_count}
+            if len(related) > self._max_related:
+                self._trim(related)
+            if related:
+                self._pairs[ebook] = related
+            else:
+                del self._pairs[ebook]
+        self._related_cache.clear()
+        self._orders_since_compaction = 0
+
+    def _trim(self, related):
+        """Keeps only the max_related most frequent neighbours in a pair mapping."""
+        keep = heapq.nlargest(self._max_related, related.items(), key=lambda item: item[1])
+        related.clear()
+        related.update(keep)
+
+
+class OrderJournal:
+    """Durable append-only journal of created orders with group commit.
+
+    Register it with ShoppingCart.add_order_listener(journal.append). Each order
+    is written as one compact JSON line; a background writer batches the lines
+    of concurrent checkouts into a single write and fsync, and append() returns
+    once its order is on disk. Segments are rotated by size, and replay()
+    rebuilds the orders and customer loyalty state after a crash.
+    """
+
+    SEGMENT_PATTERN = "orders-{:08d}.jsonl"
+
+    def __init__(self, directory, batch_size=32, flush_interval=0.002, segment_bytes=16 * 1024 * 1024):
+        """Opens a journal, starting a new segment after any existing ones.
+
+        Args:
+            directory (str): The directory holding the journal segments.
+            batch_size (int, optional): Maximum number of orders per fsync. Defaults to 32.
+            flush_interval (float, optional): Seconds the writer waits for a batch to fill
+                before syncing what it has. Defaults to 0.002.
+            segment_bytes (int, optional): Size after which a new segment is started. Defaults to 16 MiB.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._segment_bytes = segment_bytes
+        segments = self.list_segments(directory)
+        self._segment_number = int(os.path.basename(segments[-1])[7:15]) + 1 if segments else 1
+        self._file = open(self._segment_path(), "ab")
+        self._condition = threading.Condition()
+        self._pending = []
+        self._appended = 0
+        self._durable = 0
+        self._error = None
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_batches, name="order-journal", daemon=True)
+        self._writer.start()
+
+    def append(self, order, wait=True):
+        """Adds an order to the journal.
+
+        Args:
+            order (Order): The order to record.
+            wait (bool, optional): Block until the order has been fsynced. Defaults to True.
+
+        Returns:
+            int: The position of the order in this journal session.
+
+        Raises:
+            ValueError: If the journal has been closed.
+            OSError: If the batch holding the order could not be written.
+        """
+        line = self._encode(order)
+        with self._condition:
+            if self._closed:
+                raise ValueError("The order journal is closed.")
+            self._pending.append(line)
+            self._appended += 1
+            ticket = self._appended
+            if len(self._pending) == 1 or len(self._pending) >= self._batch_size:
+                self._condition.notify_all()
+            while wait and self._durable < ticket:
+                if self._error is not None:
+                    raise self._error
+                self._condition.wait()
+        return ticket
+
+    def close(self):
+        """Writes any pending orders and stops the writer."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def list_segments(directory):
+        """Returns the journal segment paths in a directory, oldest first."""
+        names = [name for name in os.listdir(directory)
+                 if name.startswith("orders-") and name.endswith(".jsonl")]
+        return [os.path.join(directory, name) for name in sorted(names)]
+
+    @classmethod
+    def replay(cls, directory, catalog=None):
+        """Rebuilds the journaled orders and customers.
+
+        Lines torn by a crash are skipped.
+
+        Args:
+            directory (str): The directory holding the journal segments.
+            catalog (Catalog, optional): Catalog used to resolve e-books by title. E-books
+                not found in it, or repriced since checkout, are rebuilt from the journal.
+
+        Returns:
+            tuple: The list of Orders in journal order, and a dict mapping each customer
+                email to its Customer with the last recorded loyalty points.
+        """
+        ebooks = {ebook.get_title(): ebook for ebook in catalog.list_items()} if catalog else {}
+        customers = {}
+        orders = []
+        for path in cls.list_segments(directory):
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    orders.append(cls._decode(record, ebooks, customers))
+        return orders, customers
+
+    @classmethod
+    def benchmark(cls, directory, batch_sizes=(1, 8, 32, 128), orders=2000, threads=16):
+        """Measures journal throughput for several group commit batch sizes.
+
+        Args:
+            directory (str): Scratch directory for the benchmark journals.
+            batch_sizes (tuple, optional): The batch sizes to compare. Defaults to (1, 8, 32, 128).
+            orders (int, optional): Orders written per batch size. Defaults to 2000.
+            threads (int, optional): Concurrent checkout threads. Defaults to 16.
+
+        Returns:
+            dict: Orders per second, keyed by batch size.
+        """
+        customer = Customer("Benchmark", "benchmark@example.com", "+0000000000")
+        order = Order(datetime.datetime(2024, 1, 1), customer)
+        for number in range(3):
+            order.add_ebook(EBook(f"E-Book {number}", "Author", datetime.datetime(2022, 1, 1),
+                                  "Fiction", Decimal('9.99'), "EPUB"))
+        per_thread = max(1, orders // threads)
+        results = {}
+        for batch_size in batch_sizes:
+            journal = cls(os.path.join(directory, f"batch-{batch_size}"), batch_size=batch_size)
+
+            def checkout():
+                for _ in range(per_thread):
+                    journal.append(order)
+
+            workers = [threading.Thread(target=checkout) for _ in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            journal.close()
+            results[batch_size] = per_thread * threads / elapsed
+        return results
+
+    def _segment_path(self):
+        """Returns the path of the segment currently written."""
+        return os.path.join(self._directory, self.SEGMENT_PATTERN.format(self._segment_number))
+
+    def _write_batches(self):
+        """Writer thread: waits for a batch to fill or time out, then writes and fsyncs it."""
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                deadline = time.monotonic() + self._flush_interval
+                while len(self._pending) < self._batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self._batch_size]
+                del self._pending[:self._batch_size]
+                if not batch:
+                    return
+            try:
+                self._file.write(b"".join(batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                if self._file.tell() >= self._segment_bytes:
+                    self._file.close()
+                    self._segment_number += 1
+                    self._file = open(self._segment_path(), "ab")
+            except OSError as error:
+                with self._condition:
+                    self._error = error
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._durable += len(batch)
+                self._condition.notify_all()
+
+    @staticmethod
+    def _encode(order):
+        """Serializes an order as one JSON line, collapsing consecutive copies of an e-book."""
+        items = []
+        previous = None
+        for ebook in order.get_ebooks():
+            if ebook is previous:
+                items[-1][-1] += 1
+                continue
+            previous = ebook
+            items.append([ebook.get_title(), ebook.get_author(), ebook.get_publication_date().isoformat(),
+                          ebook.get_genre(), str(ebook.get_price()), ebook.get_file_format(), 1])
+        customer = order.get_customer()
+        record = {
+            "date": order.get_order_date().isoformat(),
+            "customer": [customer.get_name(), customer.get_email(), customer.get_phone(),
+                         customer.get_loyalty_points()],
+            "vat": str(order.get_vat_rate()),
+            "items": items,
+        }
+        return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+    @staticmethod
+    def _decode(record, ebooks, customers):
+        """Rebuilds an Order from a journal record, reusing known e-books and customers.
+
+        Prices come from the journal. A catalog e-book is reused only while its price still
+        matches; otherwise a copy at the journaled price keeps the totals and invoice lines
+        as they were at checkout.
+        """
+        name, email, phone, loyalty_points = record["customer"]
+        customer = customers.get(email)
+        if customer is None:
+            customer = customers[email] = Customer(name, email, phone)
+        customer.set_loyalty_points(loyalty_points)
+        order = Order(datetime.datetime.fromisoformat(record["date"]), customer, vat_rate=Decimal(record["vat"]))
+        total_price = Decimal(0)
+        for title, author, publication_date, genre, price, file_format, copies in record["items"]:
+            price = Decimal(price)
+            ebook = ebooks.get(title)
+            if ebook is None or ebook.get_price() != price:
+                ebook = ebooks.get((title, price))
+                if ebook is None:
+                    ebook = ebooks[(title, price)] = EBook(title, author,
+                                                           datetime.datetime.fromisoformat(publication_date),
+                                                           genre, price, file_format)
+            for _ in range(copies):
+                order.add_ebook(ebook)
+            total_price += price * copies
+        order.set_total_price(total_price)
+        return order
+
+
+class OrderHistory:
+    """Per-customer order history kept sorted by order date.
+
+    Register it with ShoppingCart.add_order_listener(history.record_order). Each
+    customer, keyed by email, has date-sorted postings with running spend totals,
+    so range queries take O(log n) with bisect and lifetime figures are O(1).
+    Spend is the amount charged: the discounted price plus VAT.
+    """
+
+    def __init__(self, loyalty_min_orders=1):
+        """Initializes an empty history.
+
+        Args:
+            loyalty_min_orders (int, optional): Earlier orders a customer needs to qualify
+                for the loyalty discount. Defaults to 1.
+        """
+        self._loyalty_min_orders = loyalty_min_orders
+        self._lock = threading.Lock()
+        self._dates = {}
+        self._orders = {}
+        self._cumulative_spend = {}
+
+    def record_order(self, order):
+        """Adds an order to its customer's history.
+
+        Args:
+            order (Order): The order to record.
+        """
+        email = order.get_customer().get_email()
+        order_date = order.get_order_date()
+        spend = order.apply_discounts() + order.get_vat_amount()
+        with self._lock:
+            dates = self._dates.get(email)
+            if dates is None:
+                dates = self._dates[email] = []
+                self._orders[email] = []
+                self._cumulative_spend[email] = []
+            orders = self._orders[email]
+            cumulative = self._cumulative_spend[email]
+            index = bisect.bisect_right(dates, order_date)
+            dates.insert(index, order_date)
+            orders.insert(index, order)
+            previous = cumulative[index - 1] if index else Decimal('0.00')
+            cumulative.insert(index, previous + spend)
+            for later in range(index + 1, len(cumulative)):
+                cumulative[later] += spend
+
+    def get_orders(self, customer, start=None, end=None):
+        """Returns a customer's orders, oldest first.
+
+        Args:
+            customer (Customer): The customer.
+            start (datetime, optional): Only orders on or after this date.
+            end (datetime, optional): Only orders before this date.
+
+        Returns:
+            list: The matching orders.
+        """
+        email = customer.get_email()
+        with self._lock:
+            first, last = self._range(email, start, end)
+            return self._orders.get(email, [])[first:last]
+
+    def get_order_count(self, customer, start=None, end=None):
+        """Returns how many orders a customer placed, optionally within a date range.
+
+        Args:
+            customer (Customer): The customer.
+            start (datetime, optional): Only orders on or after this date.
+            end (datetime, optional): Only orders before this date.
+
+        Returns:
+            int: The number of orders.
+        """
+        with self._lock:
+            first, last = self._range(customer.get_email(), start, end)
+            return last - first
+
+    def get_spend(self, customer, start=None, end=None):
+        """Returns how much a customer spent, optionally within a date range.
+
+        Args:
+            customer (Customer): The customer.
+            start (datetime, optional): Only orders on or after this date.
+            end (datetime, optional): Only orders before this date.
+
+        Returns:
+            Decimal: The total charged for the matching orders.
+        """
+        email = customer.get_email()
+        with self._lock:
+            first, last = self._range(email, start, end)
+            if first >= last:
+                return Decimal('0.00')
+            cumulative = self._cumulative_spend[email]
+            return cumulative[last - 1] - (cumulative[first - 1] if first else Decimal('0.00'))
+
+    def get_lifetime_value(self, customer):
+        """Returns the total a customer has spent across all orders."""
+        cumulative = self._cumulative_spend.get(customer.get_email())
+        return cumulative[-1] if cumulative else Decimal('0.00')
+
+    def is_loyal_customer(self, customer, as_of):
+        """Returns True if a customer placed enough orders before a date for the loyalty discount.
+
+        Args:
+            customer (Customer): The customer.
+            as_of (datetime): Orders on or after this date are not counted.
+
+        Returns:
+            bool: Whether the customer qualifies.
+        """
+        return self.get_order_count(customer, end=as_of) >= self._loyalty_min_orders
+
+    def _range(self, email, start, end):
+        """Returns the index range of a customer's postings within [start, end)."""
+        dates = self._dates.get(email)
+        if not dates:
+            return 0, 0
+        first = bisect.bisect_left(dates, start) if start is not None else 0
+        last = bisect.bisect_left(dates, end) if end is not None else len(dates)
+        return first, last
+
+
+class CartSessionStore:
+    """Bounded store of open shopping carts, keyed by customer email.
+
+    Carts idle for longer than the TTL expire, and once the cart or item cap is
+    exceeded the least recently used carts are evicted. With a spill directory,
+    evicted carts are written to disk and reloaded the next time their customer
+    asks for a cart, unless they were spilled longer than the TTL ago.
+    """
+
+    def __init__(self, max_carts=10000, max_items=None, ttl=1800, spill_directory=None, catalog=None,
+                 clock=time.monotonic, wall_clock=time.time):
+        """Initializes an empty session store.
+
+        Args:
+            max_carts (int, optional): Maximum number of carts held in memory. Defaults to 10000.
+            max_items (int, optional): Maximum number of cart lines held in memory, as a memory
+                bound. Carts report their line count as items are added or removed. Defaults to None.
+            ttl (float, optional): Seconds a cart may stay idle before it expires. Defaults to 1800.
+            spill_directory (str, optional): Directory evicted carts are written to. Defaults to None,
+                which discards evicted carts.
+            catalog (Catalog, optional): Catalog used to resolve the e-books of reloaded carts.
+            clock (callable, optional): Returns the current time in seconds. Defaults to time.monotonic.
+            wall_clock (callable, optional): Returns the wall-clock time in seconds, used to age spill
+                files across restarts. Defaults to time.time.
+        """
+        self._max_carts = max_carts
+        self._max_items = max_items
+        self._ttl = ttl
+        self._spill_directory = spill_directory
+        self._catalog = catalog
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()
+        self._item_count = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "spills": 0, "reloads": 0}
+        if spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok=True)
+
+    def get_cart(self, customer):
+        """Returns the customer's open cart, reloading or creating it if needed.
+
+        Args:
+            customer (Customer): The customer whose cart is wanted.
+
+        Returns:
+            ShoppingCart: The customer's cart.
+        """
+        email = customer.get_email()
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            session = self._sessions.get(email)
+            if session is not None:
+                self._stats["hits"] += 1
+                self._sessions.move_to_end(email)
+                session[1] = now
+                return session[0]
+
+            self._stats["misses"] += 1
+            cart = self._reload(customer)
+            if cart is None:
+                cart = ShoppingCart(customer)
+            session = self._sessions[email] = [cart, now, 0]
+            self._refresh_size(session)
+            self._enforce_limits()
+            cart.set_size_listener(self._on_cart_resized)
+            return cart
+
+    def remove_cart(self, customer):
+        """Discards a customer's cart, e.g. after checkout.
+
+        Args:
+            customer (Customer): The customer whose cart is discarded.
+        """
+        email = customer.get_email()
+        with self._lock:
+            session = self._sessions.pop(email, None)
+            if session is not None:
+                self._drop(session)
+            if self._spill_directory is not None:
+                path = self._spill_path(email)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def expire(self):
+        """Drops every cart that has been idle for longer than the TTL, in memory and on disk.
+
+        Returns:
+            int: The number of carts expired.
+        """
+        with self._lock:
+            expired = self._expire(self._clock())
+            if self._spill_directory is not None:
+                before = self._stats["expirations"]
+                for name in os.listdir(self._spill_directory):
+                    if name.endswith(".json"):
+                        self._read_spill(os.path.join(self._spill_directory, name))
+                expired += self._stats["expirations"] - before
+            return expired
+
+    def get_stats(self):
+        """Returns the hit, miss, eviction, expiration, spill and reload counters.
+
+        Returns:
+            dict: The counters plus the current number of carts and cart lines.
+        """
+        with self._lock:
+            return dict(self._stats, carts=len(self._sessions), items=self._item_count)
+
+    def __len__(self):
+        """Returns the number of carts held in memory."""
+        return len(self._sessions)
+
+    def _expire(self, now):
+        """Drops idle carts from the least recently used end; the caller holds the lock."""
+        expired = 0
+        while self._sessions:
+            email, session = next(iter(self._sessions.items()))
+            if now - session[1] <= self._ttl:
+                break
+            del self._sessions[email]
+            self._drop(session)
+            expired += 1
+        self._stats["expirations"] += expired
+        return expired
+
+    def _enforce_limits(self):
+        """Evicts least recently used carts until both caps hold; the caller holds the lock."""
+        while len(self._sessions) > 1 and (
+                len(self._sessions) > self._max_carts
+                or (self._max_items is not None and self._item_count > self._max_items)):
+            email, session = self._sessions.popitem(last=False)
+            self._drop(session)
+            self._stats["evictions"] += 1
+            if self._spill_directory is not None and session[0].get_items():
+                self._spill(email, session[0])
+
+    def _refresh_size(self, session):
+        """Updates the stored line count of a session."""
+        size = len(session[0].get_items())
+        self._item_count += size - session[2]
+        session[2] = size
+
+    def _on_cart_resized(self, cart):
+        """Counts the new size of a held cart and evicts other carts if the item cap is exceeded."""
+        with self._lock:
+            email = cart.get_customer().get_email()
+            session = self._sessions.get(email)
+            if session is None or session[0] is not cart:
+                return
+            self._sessions.move_to_end(email)
+            session[1] = self._clock()
+            self._refresh_size(session)
+            self._enforce_limits()
+
+    def _drop(self, session):
+        """Stops counting a session that has left the store; the caller holds the lock."""
+        self._item_count -= session[2]
+        session[0].set_size_listener(None)
+
+    def _spill_path(self, email):
+        """Returns the spill file path for a customer email."""
+        return os.path.join(self._spill_directory, hashlib.sha1(email.encode("utf-8")).hexdigest() + ".json")
+
+    def _spill(self, email, cart):
+        """Writes an evicted cart to disk."""
+        items = [[ebook.get_title(), ebook.get_author(), ebook.get_publication_date().isoformat(),
+                  ebook.get_genre(), str(ebook.get_price()), ebook.get_file_format(), quantity]
+                 for ebook, quantity in cart.get_items()]
+        path = self._spill_path(email)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"email": email, "spilled_at": self._wall_clock(), "items": items}, file)
+        os.replace(temp_path, path)
+        self._stats["spills"] += 1
+
+    def _read_spill(self, path):
+        """Returns a spill file's contents, deleting it instead if it has expired or is unreadable."""
+        try:
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            os.remove(path)
+            return None
+        if self._wall_clock() - data.get("spilled_at", 0) > self._ttl:
+            os.remove(path)
+            self._stats["expirations"] += 1
+            return None
+        return data
+
+    def _reload(self, customer):
+        """Rebuilds a spilled cart at current catalog prices, or returns None if there is none."""
+        if self._spill_directory is None:
+            return None
+        path = self._spill_path(customer.get_email())
+        data = self._read_spill(path)
+        if data is None:
+            return None
+        cart = ShoppingCart(customer)
+        for title, author, publication_date, genre, price, file_format, quantity in data["items"]:
+            ebook = self._catalog.find_by_title(title) if self._catalog is not None else None
+            if ebook is None:
+                ebook = EBook(title, author, datetime.datetime.fromisoformat(publication_date),
+                              genre, Decimal(price), file_format)
+            cart.add_item(ebook, quantity)
+        os.remove(path)
+        self._stats["reloads"] += 1
+        return cart
+
+
+class ShardedStore:
+    """Spreads customers and their carts across local worker processes.
+
+    Customers are assigned to shards by a stable hash of their email, and each
+    worker process owns its shard outright, so cart and order operations on
+    different shards run on different cores. Requests travel over a pipe as
+    (operation, arguments) tuples; queries spanning every customer are sent to
+    all shards at once and the partial results combined.
+    """
+
+    def __init__(self, num_shards=None, start_method=None):
+        """Starts the shard worker processes.
+
+        Args:
+            num_shards (int, optional): Number of worker processes. Defaults to the CPU count.
+            start_method (str, optional): The multiprocessing start method, e.g. "fork" or
+                "spawn". Defaults to the platform default.
+        """
+        self._context = multiprocessing.get_context(start_method)
+        self._shards = []
+        self._ebooks = {}
+        self._condition = threading.Condition()
+        self._active_requests = 0
+        self._paused = False
+        self._start_shards(self._shards, num_shards or os.cpu_count() or 1)
+
+    def get_num_shards(self):
+        """Returns the number of worker processes."""
+        return len(self._shards)
+
+    def get_shard_index(self, email):
+        """Returns the shard that owns a customer email.
+
+        Args:
+            email (str): The customer's email address.
+
+        Returns:
+            int: The shard index.
+        """
+        return self._shard_index(email, len(self._shards))
+
+    def add_customer(self, customer):
+        """Adds a customer, or replaces the customer with the same email.
+
+        Args:
+            customer (Customer): The customer to add.
+        """
+        self._call(customer.get_email(), "add_customer", customer)
+
+    def get_customer(self, email):
+        """Returns a copy of a customer, or None if there is no customer with that email."""
+        return self._call(email, "get_customer", email)
+
+    def remove_customer(self, email):
+        """Removes a customer and their cart.
+
+        Returns:
+            bool: True if the customer existed.
+        """
+        return self._call(email, "remove_customer", email)
+
+    def add_to_cart(self, email, ebook, quantity=1):
+        """Adds an e-book to a customer's cart.
+
+        Args:
+            email (str): The customer's email address.
+            ebook (EBook): The e-book to add.
+            quantity (int, optional): The quantity to add. Defaults to 1.
+
+        Returns:
+            Decimal: The new cart total.
+
+        Raises:
+            KeyError: If there is no customer with that email.
+        """
+        self._track_ebook(ebook)
+        return self._call(email, "add_to_cart", email, ebook, quantity)
+
+    def remove_from_cart(self, email, ebook):
+        """Removes an e-book from a customer's cart and returns the new cart total."""
+        return self._call(email, "remove_from_cart", email, ebook.get_title())
+
+    def update_quantity(self, email, ebook, quantity):
+        """Sets the quantity of an e-book in a customer's cart and returns the new cart total."""
+        self._track_ebook(ebook)
+        return self._call(email, "update_quantity", email, ebook, quantity)
+
+    def get_cart_total(self, email):
+        """Returns the total price of a customer's cart."""
+        return self._call(email, "get_cart_total", email)
+
+    def checkout(self, email, order_date):
+        """Creates an order from a customer's cart and closes the cart.
+
+        The order is created in the shard's worker process. Its e-books are copies, so
+        they are swapped for the e-books that were added to the cart in this process
+        before the order is delivered to the order listeners registered here.
+
+        Args:
+            email (str): The customer's email address.
+            order_date (datetime): The date of the order.
+
+        Returns:
+            Order: The created order, or a message if the cart is empty.
+        """
+        order = self._call(email, "checkout", email, order_date)
+        if isinstance(order, Order):
+            order.set_ebooks([self._ebooks.get(ebook.get_title(), ebook) for ebook in order.get_ebooks()])
+            ShoppingCart.notify_order_listeners(order)
+        return order
+
+    def on_price_change(self, ebook, old_price, new_price):
+        """Reprice an e-book in every shard, so open cart totals follow the catalog.
+
+        Args:
+            ebook (EBook): The repriced e-book.
+            old_price (Decimal): The previous price.
+            new_price (Decimal): The new price.
+        """
+        self._gather("reprice", ebook.get_title(), new_price)
+
+    def update_loyalty_points(self, email, points):
+        """Adds loyalty points to a customer and returns their new balance."""
+        return self._call(email, "update_loyalty_points", email, points)
+
+    def get_customer_count(self):
+        """Returns the number of customers across all shards."""
+        return sum(self._gather("customer_count"))
+
+    def get_total_loyalty_points(self):
+        """Returns the sum of every customer's loyalty points across all shards."""
+        return sum(self._gather("loyalty_points_total"))
+
+    def resize(self, num_shards):
+        """Changes the number of shards, moving every customer and cart to its new shard.
+
+        Requests from other threads wait until the data has moved. The old shards
+        keep their data until every new shard has imported its part; if anything
+        fails, the new shards are stopped and the old layout is kept.
+
+        Args:
+            num_shards (int): The new number of worker processes.
+        """
+        with self._paused_requests():
+            entries = [entry for shard_entries in self._gather_from(self._shards, "export")
+                       for entry in shard_entries]
+            new_shards = []
+            try:
+                self._start_shards(new_shards, num_shards)
+                moved = [[] for _ in range(num_shards)]
+                for entry in entries:
+                    moved[self._shard_index(entry[0].get_email(), num_shards)].append(entry)
+                for shard, shard_entries in zip(new_shards, moved):
+                    if shard_entries:
+                        self._request(shard, "import", shard_entries)
+            except BaseException:
+                self._stop_shards(new_shards)
+                raise
+            old_shards, self._shards = self._shards, new_shards
+        self._stop_shards(old_shards)
+
+    def close(self):
+        """Stops every worker process."""
+        with self._paused_requests():
+            self._stop_shards(self._shards)
+            self._shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _stop_shards(self, shards):
+        """Stops the given worker processes, terminating any that no longer respond."""
+        for process, connection, lock in shards:
+            with lock:
+                try:
+                    connection.send(("stop", ()))
+                    connection.recv()
+                except (OSError, EOFError):
+                    process.terminate()
+        for process, connection, _ in shards:
+            process.join()
+            connection.close()
+
+    def _start_shards(self, shards, num_shards):
+        """Starts one worker process per shard, appending each to shards as it starts."""
+        for _ in range(num_shards):
+            connection, child_connection = self._context.Pipe()
+            process = self._context.Process(target=_ShardServer.run, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            shards.append((process, connection, threading.Lock()))
+
+    @staticmethod
+    def _shard_index(email, num_shards):
+        """Returns the shard that owns an email among num_shards shards."""
+        return zlib.crc32(email.lower().encode("utf-8")) % num_shards
+
+    @contextlib.contextmanager
+    def _shared_requests(self):
+        """Lets requests run concurrently with each other, but not with a resize."""
+        with self._condition:
+            while self._paused:
+                self._condition.wait()
+            self._active_requests += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active_requests -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def _paused_requests(self):
+        """Waits for running requests to finish and holds back new ones."""
+        with self._condition:
+            while self._paused:
+                self._condition.wait()
+            self._paused = True
+            while self._active_requests:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._paused = False
+                self._condition.notify_all()
+
+    def _track_ebook(self, ebook):
+        """Remembers the e-book forwarded for a title and follows its price changes."""
+        previous = self._ebooks.get(ebook.get_title())
+        if previous is not ebook:
+            if previous is not None:
+                previous.remove_price_listener(self)
+            self._ebooks[ebook.get_title()] = ebook
+            ebook.add_price_listener(self)
+
+    def _call(self, email, operation, *args):
+        """Sends a request to the shard owning an email."""
+        with self._shared_requests():
+            return self._request(self._shards[self.get_shard_index(email)], operation, *args)
+
+    def _request(self, shard, operation, *args):
+        """Sends a request to one shard and returns its result, re-raising any error."""
+        _, connection, lock = shard
+        with lock:
+            connection.send((operation, args))
+            status, result = connection.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def _gather(self, operation, *args):
+        """Sends a request to every shard at once and returns their results in shard order."""
+        with self._shared_requests():
+            return self._gather_from(self._shards, operation, *args)
+
+    def _gather_from(self, shards, operation, *args):
+        """Sends a request to each of the given shards and returns their results in order."""
+        for _, connection, lock in shards:
+            lock.acquire()
+        try:
+            for _, connection, _ in shards:
+                connection.send((operation, args))
+            responses = [connection.recv() for _, connection, _ in shards]
+        finally:
+            for _, _, lock in shards:
+                lock.release()
+        for status, result in responses:
+            if status == "error":
+                raise result
+        return [result for _, result in responses]
+
+
+class _ShardServer:
+    """Holds one shard's customers and carts inside a worker process."""
+
+    def __init__(self):
+        """Initializes an empty shard."""
+        self._customers = CustomerList()
+        self._by_email = {}
+        self._carts = {}
+        self._ebooks = {}
+
+    @classmethod
+    def run(cls, connection):
+        """Serves requests from the parent process until told to stop."""
+        # Forked workers inherit the parent's order listeners, whose state (journal
+        # writer threads, analytics) lives in the parent; orders are delivered there.
+        ShoppingCart._order_listeners = []
+        server = cls()
+        while True:
+            operation, args = connection.recv()
+            if operation == "stop":
+                connection.send(("ok", None))
+                connection.close()
+                return
+            try:
+                result = getattr(server, f"_op_{operation}")(*args)
+            except Exception as error:
+                try:
+                    connection.send(("error", error))
+                except Exception:
+                    connection.send(("error", RuntimeError(repr(error))))
+            else:
+                connection.send(("ok", result))
+
+    def _customer(self, email):
+        """Returns the customer with an email, raising KeyError if there is none."""
+        customer = self._by_email.get(email.lower())
+        if customer is None:
+            raise KeyError(f"Customer not found: {email}")
+        return customer
+
+    def _cart(self, email):
+        """Returns a customer's cart, creating it if needed."""
+        cart = self._carts.get(email.lower())
+        if cart is None:
+            cart = self._carts[email.lower()] = ShoppingCart(self._customer(email))
+        return cart
+
+    def _ebook(self, ebook):
+        """Returns the shard's copy of an e-book, updating its price if it changed."""
+        existing = self._ebooks.get(ebook.get_title())
+        if existing is None:
+            existing = self._ebooks[ebook.get_title()] = ebook
+        elif existing.get_price() != ebook.get_price():
+            existing.set_price(ebook.get_price())
+        return existing
+
+    def _op_add_customer(self, customer):
+        """Adds or replaces a customer."""
+        email = customer.get_email().lower()
+        previous = self._by_email.get(email)
+        if previous is not None:
+            self._customers.get_customers().remove(previous)
+        self._customers.get_customers().append(customer)
+        self._by_email[email] = customer
+        cart = self._carts.get(email)
+        if cart is not None:
+            cart.set_customer(customer)
+
+    def _op_get_customer(self, email):
+        """Returns a customer, or None."""
+        return self._by_email.get(email.lower())
+
+    def _op_remove_customer(self, email):
+        """Removes a customer and their cart."""
+        customer = self._by_email.pop(email.lower(), None)
+        self._carts.pop(email.lower(), None)
+        if customer is None:
+            return False
+        self._customers.get_customers().remove(customer)
+        return True
+
+    def _op_add_to_cart(self, email, ebook, quantity):
+        """Adds an e-book to a cart and returns the cart total."""
+        cart = self._cart(email)
+        cart.add_item(self._ebook(ebook), quantity)
+        return cart.get_total_price()
+
+    def _op_remove_from_cart(self, email, title):
+        """Removes an e-book from a cart and returns the cart total."""
+        cart = self._cart(email)
+        ebook = self._ebooks.get(title)
+        if ebook is not None:
+            cart.remove_item(ebook)
+        return cart.get_total_price()
+
+    def _op_update_quantity(self, email, ebook, quantity):
+        """Sets the quantity of an e-book in a cart and returns the cart total."""
+        cart = self._cart(email)
+        cart.update_quantity(self._ebook(ebook), quantity)
+        return cart.get_total_price()
+
+    def _op_reprice(self, title, price):
+        """Sets the price of the shard's copy of an e-book, updating the carts holding it."""
+        ebook = self._ebooks.get(title)
+        if ebook is not None:
+            ebook.set_price(price)
+
+    def _op_get_cart_total(self, email):
+        """Returns the cart total of a customer."""
+        self._customer(email)
+        cart = self._carts.get(email.lower())
+        return cart.get_total_price() if cart is not None else Decimal('0.00')
+
+    def _op_checkout(self, email, order_date):
+        """Creates an order from a cart and closes the cart."""
+        order = self._cart(email).create_order(order_date)
+        if isinstance(order, Order):
+            del self._carts[email.lower()]
+        return order
+
+    def _op_update_loyalty_points(self, email, points):
+        """Adds loyalty points to a customer and returns the new balance."""
+        customer = self._customer(email)
+        customer.set_loyalty_points(customer.get_loyalty_points() + points)
+        return customer.get_loyalty_points()
+
+    def _op_customer_count(self):
+        """Returns the number of customers in the shard."""
+        return len(self._by_email)
+
+    def _op_loyalty_points_total(self):
+        """Returns the loyalty points held by the shard's customers."""
+        return sum(customer.get_loyalty_points() for customer in self._by_email.values())
+
+    def _op_export(self):
+        """Returns every customer and cart, leaving the shard unchanged."""
+        entries = []
+        for email, customer in self._by_email.items():
+            cart = self._carts.get(email)
+            entries.append((customer, list(cart.get_items()) if cart is not None else []))
+        return entries
+
+    def _op_import(self, entries):
+        """Adds customers and their cart items exported by another shard."""
+        for customer, items in entries:
+            self._op_add_customer(customer)
+            for ebook, quantity in items:
+                self._op_add_to_cart(customer.get_email(), ebook, quantity)
+
+
+class LoadGenerator:
+    """Replays realistic checkout traffic and reports per-operation latency percentiles.
+
+    Operations are catalog searches, cart edits, create_order calls and invoice
+    renders. They are either synthesized from a weighted mix or loaded from a
+    recorded JSONL log, then issued at a target rate by several worker threads.
+    Each customer's operations always go to the same worker, so carts are never
+    shared between threads. Latency is measured from the time an operation was
+    scheduled to start, so a store that falls behind the target rate shows the
+    queueing delay instead of hiding it.
+    """
+
+    DEFAULT_MIX = {"search": 0.5, "cart_edit": 0.3, "create_order": 0.1, "render_invoice": 0.1}
+    PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))
+
+    def __init__(self, catalog, customers, rate=500, concurrency=4):
+        """Initializes a load generator.
+
+        Args:
+            catalog (Catalog): The catalog to search and buy from.
+            customers (list): The customers placing orders.
+            rate (float, optional): Target operations per second, or None to run
+                as fast as possible. Defaults to 500.
+            concurrency (int, optional): Number of worker threads. Defaults to 4.
+        """
+        self._catalog = catalog
+        self._customers = customers
+        self._rate = rate
+        self._concurrency = concurrency
+
+    def synthesize(self, count, mix=None, seed=None):
+        """Generates a random operation stream.
+
+        Args:
+            count (int): Number of operations.
+            mix (dict, optional): Relative weight of each operation type. Defaults to DEFAULT_MIX.
+            seed (int, optional): Seed for a reproducible stream.
+
+        Returns:
+            list: Operation dictionaries, each with an "op" key.
+        """
+        mix = mix or self.DEFAULT_MIX
+        generator = random.Random(seed)
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        titles = [ebook.get_title() for ebook in self._catalog.list_items()]
+        genres = sorted({ebook.get_genre() for ebook in self._catalog.list_items()})
+        operations = []
+        for name in generator.choices(names, weights, k=count):
+            customer = generator.randrange(len(self._customers))
+            if name == "search":
+                if generator.random() < 0.8:
+                    operations.append({"op": name, "title": generator.choice(titles)})
+                else:
+                    operations.append({"op": name, "genre": generator.choice(genres)})
+            elif name == "cart_edit":
+                operations.append({"op": name, "customer": customer, "title": generator.choice(titles),
+                                   "action": generator.choice(("add", "add", "update", "remove")),
+                                   "quantity": generator.randint(1, 3)})
+            else:
+                operations.append({"op": name, "customer": customer})
+        return operations
+
+    @staticmethod
+    def save_log(operations, path):
+        """Records an operation stream as JSON lines so it can be replayed later."""
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(operation) + "\n" for operation in operations)
+
+    @staticmethod
+    def load_log(path):
+        """Reads an operation stream recorded by save_log."""
+        with open(path, encoding="utf-8") as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def run(self, operations):
+        """Issues the operations at the target rate and measures them.
+
+        Args:
+            operations (list): Operations from synthesize or load_log.
+
+        Returns:
+            dict: The run settings, overall throughput, and per-operation count, mean, max
+                and p50/p95/p99/p999 latency in milliseconds.
+        """
+        queues = [[] for _ in range(self._concurrency)]
+        for position, operation in enumerate(operations):
+            worker = operation.get("customer", position) % self._concurrency
+            queues[worker].append((position, operation))
+        latencies = collections.defaultdict(list)
+        lock = threading.Lock()
+        start = time.perf_counter() + 0.01
+
+        def work(queue):
+            carts = {}
+            orders = {}
+            measured = collections.defaultdict(list)
+            for position, operation in queue:
+                scheduled = start + position / self._rate if self._rate else time.perf_counter()
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if self._execute(operation, carts, orders):
+                    measured[operation["op"]].append(time.perf_counter() - scheduled)
+            with lock:
+                for name, values in measured.items():
+                    latencies[name].extend(values)
+
+        workers = [threading.Thread(target=work, args=(queue,)) for queue in queues]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        total = sum(len(values) for values in latencies.values())
+        return {
+            "rate": self._rate,
+            "concurrency": self._concurrency,
+            "elapsed_seconds": elapsed,
+            "throughput": total / elapsed if elapsed > 0 else 0.0,
+            "operations": {name: self._summarize(values) for name, values in sorted(latencies.items())},
+        }
+
+    @staticmethod
+    def save_results(results, path):
+        """Writes run results to a JSON file."""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    @staticmethod
+    def load_results(path):
+        """Reads run results written by save_results."""
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+
+    @staticmethod
+    def compare_results(baseline, current):
+        """Compares two runs.
+
+        Args:
+            baseline (dict): Results of the earlier run.
+            current (dict): Results of the later run.
+
+        Returns:
+            dict: For the throughput and each operation's percentiles present in both runs,
+                the ratio current / baseline; above 1.0 means higher than before.
+        """
+        comparison = {}
+        if baseline["throughput"]:
+            comparison["throughput"] = current["throughput"] / baseline["throughput"]
+        for name, before in baseline["operations"].items():
+            after = current["operations"].get(name)
+            if after is None:
+                continue
+            comparison[name] = {label: after[label] / before[label]
+                                for label, _ in LoadGenerator.PERCENTILES if before[label]}
+        return comparison
+
+    def _execute(self, operation, carts, orders):
+        """Runs one operation; returns False if there was nothing to do."""
+        name = operation["op"]
+        if name == "search":
+            if "title" in operation:
+                self._catalog.find_by_title(operation["title"])
+            else:
+                self._catalog.filter_by_genre(operation["genre"])
+            return True
+
+        customer = operation["customer"]
+        if name == "cart_edit":
+            cart = carts.get(customer)
+            if cart is None:
+                cart = carts[customer] = ShoppingCart(self._customers[customer])
+            ebook = self._catalog.find_by_title(operation["title"])
+            if ebook is None:
+                return False
+            if operation["action"] == "add":
+                cart.add_item(ebook, operation["quantity"])
+            elif operation["action"] == "update":
+                cart.update_quantity(ebook, operation["quantity"])
+            else:
+                cart.remove_item(ebook)
+            return True
+        if name == "create_order":
+            cart = carts.pop(customer, None)
+            if cart is None:
+                return False
+            order = cart.create_order(datetime.datetime.now())
+            if isinstance(order, Order):
+                orders[customer] = order
+            return True
+        if name == "render_invoice":
+            order = orders.get(customer)
+            if order is None:
+                return False
+            order.render_invoice()
+            return True
+        raise ValueError(f"Unknown operation: {name}")
+
+    @classmethod
+    def _summarize(cls, values):
+        """Returns the count, mean, max and percentiles of latencies, in milliseconds."""
+        values = sorted(values)
+        summary = {"count": len(values),
+                   "mean": sum(values) / len(values) * 1000,
+                   "max": values[-1] * 1000}
+        for label, fraction in cls.PERCENTILES:
+            rank = max(1, math.ceil(fraction * len(values)))
+            summary[label] = values[rank - 1] * 1000
+        return summary